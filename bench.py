@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for the functions that run once per page or per row, on
+synthetic data, so they run offline and give the same work on every run.
+
+Each benchmark is timed with timeit: the number of calls per timing is
+chosen so that a timing takes at least 0.2 seconds, the timing is repeated
+REPEAT times, and the fastest is kept (slower timings are noise from the
+rest of the machine, not the code). The results are printed as JSON, and
+can be saved and compared with a later run:
+
+    ./bench.py --output before.json
+    ... change something ...
+    ./bench.py --baseline before.json
+
+which exits with status 1 if any benchmark got slower than the baseline by
+more than the threshold (20% by default). Benchmarks that need a library
+that isn't installed (BeautifulSoup, dateutil) are skipped.
+"""
+
+import argparse
+import datetime
+import io
+import json
+import platform
+import random
+import sys
+import timeit
+
+import proc
+import table_scanner
+import util
+
+REPEAT = 5
+THRESHOLD = 0.2
+RENDER_SIZES = [1000, 10000, 100000]
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Decorator for a function that sets up the benchmark name and returns
+    the function to time. The setup function may raise ImportError to skip
+    the benchmark."""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+# Synthetic data. Everything is made from a seeded random generator, so every
+# run times the same work.
+
+SUBJECTS = ["OpenAI", "malaria", "the Ottoman Empire", "Wikipedia",
+            "cryptocurrency", "Airbnb", "the Internet", "vaccine development",
+            "Amazon", "machine learning"]
+ADJECTIVES = ["Brief", "Chinese", "Recent", "Early"]
+TOPICS = ["", "Artificial intelligence", "Health", "Tech company",
+          "Miscellaneous health", "History"]
+
+
+def pagenames(n, seed=0):
+    r = random.Random(seed)
+    names = []
+    for i in range(n):
+        subject = "%s %d" % (r.choice(SUBJECTS), i)
+        form = r.random()
+        if form < 0.7:
+            names.append("Timeline of " + subject)
+        elif form < 0.85:
+            names.append("Timeline of the " + subject)
+        else:
+            names.append("%s timeline of %s" % (r.choice(ADJECTIVES), subject))
+    return names
+
+
+def months(n, seed=0):
+    r = random.Random(seed)
+    return [datetime.date(r.randint(2014, 2025), r.randint(1, 12), 1)
+            .strftime("%B %Y") if r.random() > 0.05 else ""
+            for _ in range(n)]
+
+
+def table_rows(n, seed=0):
+    """Rows like the ones print_table.load_rows returns."""
+    r = random.Random(seed)
+    rows = []
+    for pagename, creation, modified in zip(pagenames(n, seed),
+                                            months(n, seed + 1),
+                                            months(n, seed + 2)):
+        paid = r.random() < 0.6
+        contributors = ", ".join(r.sample(["Issa Rice", "Vipul Naik",
+                                           "Sebastian", "Amana Rice"],
+                                          r.randint(1, 3))) if paid else ""
+        rows.append({
+            "pagename": pagename,
+            "topic": r.choice(TOPICS),
+            "creation_month": creation,
+            "last_modified_month": modified or "May 2024",
+            "number_of_rows": r.choice([None, r.randint(0, 2000)]),
+            "payment": round(r.uniform(1, 3000), 2) if paid else 0.0,
+            "monthly_pageviews": r.choice([0, r.randint(1, 50000)]),
+            "monthly_wikipedia_pageviews": r.choice([0, r.randint(1, 50000)]),
+            "principal_contributors_by_amount": contributors,
+            "principal_contributors_alphabetical": contributors,
+            "principal_contributors_by_amount_html": contributors,
+        })
+    return rows
+
+
+def timeline_html(rows, seed=0):
+    """A rendered timeline page, laid out like the wiki's, with a full
+    timeline table of rows rows."""
+    r = random.Random(seed)
+    parts = ['<html><body><div class="mw-parser-output">',
+             '<p>This is a timeline of something.</p>',
+             '<div class="mw-heading mw-heading2"><h2 id="Big_picture">'
+             'Big picture</h2></div>',
+             '<table class="wikitable not-full-timeline"><tr><th>Time period'
+             '</th><th>Development summary</th></tr>']
+    parts += ['<tr><td>%d</td><td>Summary %d</td></tr>' % (1900 + i, i)
+              for i in range(20)]
+    parts += ['</table>',
+              '<div class="mw-heading mw-heading2"><h2 id="Full_timeline">'
+              'Full timeline</h2></div>',
+              '<table class="sortable wikitable"><tr><th>Year</th>'
+              '<th>Event type</th><th>Details</th></tr>']
+    for i in range(rows):
+        parts.append('<tr><td>%d</td><td>%s</td><td>Something happened, '
+                     'see <a href="https://example.com/%d">this</a>.<sup '
+                     'class="reference"><a href="#cite_note-%d">[%d]</a>'
+                     '</sup></td></tr>'
+                     % (r.randint(1900, 2025), r.choice(["Launch", "Funding",
+                                                         "Research"]),
+                        i, i, i))
+    parts += ['</table>',
+              '<div class="mw-heading mw-heading2"><h2 id="See_also">See also'
+              '</h2></div><ul><li>Other timeline</li></ul>',
+              '</div></body></html>']
+    return "".join(parts)
+
+
+# The benchmarks
+
+@benchmark("page_display_name/10k")
+def bench_page_display_name():
+    names = pagenames(10000)
+    return lambda: [util.page_display_name(name) for name in names]
+
+
+@benchmark("dictionary_ordering/sort_10k")
+def bench_dictionary_ordering():
+    names = pagenames(10000)
+    return lambda: sorted(names, key=proc.dictionary_ordering)
+
+
+@benchmark("pageviews_date_range/10k")
+def bench_pageviews_date_range():
+    names = pagenames(10000)
+    articles = {name: {"topic": "", "creation_month": month}
+                for name, month in zip(names, months(10000))}
+    # Stand in for the contractwork data, so that nothing is loaded from
+    # MySQL or a dump (this script never needs the real data)
+    proc.articles = lambda: articles
+    return lambda: [proc.pageviews_date_range(name) for name in names]
+
+
+@benchmark("count_rows/scanner_5k_rows")
+def bench_count_rows():
+    html = timeline_html(5000)
+    return lambda: table_scanner.count_rows(html)
+
+
+@benchmark("count_rows/soup_5k_rows")
+def bench_soup_count_rows():
+    # Parsing, then full_timeline_heading and full_timeline_table
+    import bs4  # noqa: F401 (skip the benchmark if it isn't installed)
+
+    html = timeline_html(5000)
+    return lambda: table_scanner.soup_count_rows(html)
+
+
+@benchmark("full_timeline_table/5k_rows")
+def bench_full_timeline_table():
+    # The two lookups alone, on an already parsed page
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(timeline_html(5000), "lxml")
+    return lambda: proc.full_timeline_table(soup,
+                                            proc.full_timeline_heading(soup))
+
+
+@benchmark("month_order/sort_10k")
+def bench_month_order():
+    import print_table
+
+    values = months(10000)
+    return lambda: sorted(values, key=print_table.month_order)
+
+
+def bench_render(size, summary):
+    def setup():
+        import print_table
+
+        rows = table_rows(size)
+        if summary:
+            return lambda: print_table.print_summary_tables(rows, io.StringIO())
+        return lambda: print_table.print_table(rows, io.StringIO())
+    return setup
+
+
+for size in RENDER_SIZES:
+    benchmark("print_table/%d" % size)(bench_render(size, False))
+    benchmark("print_summary_tables/%d" % size)(bench_render(size, True))
+
+
+def run(name_filter=None, repeat=REPEAT):
+    """Run the benchmarks whose names contain name_filter (or all of them),
+    and return the results as a dict that can be dumped as JSON."""
+    results = {}
+    skipped = {}
+    for name, setup in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        try:
+            f = setup()
+        except ImportError as e:
+            skipped[name] = str(e)
+            continue
+        timer = timeit.Timer(f)
+        number, _ = timer.autorange()
+        seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+        results[name] = {"seconds": seconds, "number": number,
+                         "repeat": repeat}
+        print("%-36s %12.6f ms" % (name, seconds * 1000), file=sys.stderr)
+    return {"python": platform.python_version(),
+            "machine": platform.machine(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "results": results,
+            "skipped": skipped}
+
+
+def regressions(report, baseline, threshold=THRESHOLD):
+    """Compare report with baseline (both as returned by run) and return a
+    list of (name, baseline seconds, seconds) for the benchmarks that got
+    slower by more than threshold (a fraction)."""
+    slower = []
+    for name, result in report["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        print("%-36s %+7.1f%%" % (name, (ratio - 1) * 100), file=sys.stderr)
+        if ratio > 1 + threshold:
+            slower.append((name, before["seconds"], result["seconds"]))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Time the per-page and per-row functions on "
+                        "synthetic data.")
+    parser.add_argument("--filter", metavar="TEXT",
+                        help="only run the benchmarks whose names contain "
+                             "TEXT")
+    parser.add_argument("--repeat", type=int, default=REPEAT,
+                        help="number of timings to take the fastest of "
+                             "(default: %(default)s)")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results to FILE as JSON instead of "
+                             "standard output")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare with the results saved in FILE and "
+                             "fail if anything got slower by more than the "
+                             "threshold")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown compared with the baseline, "
+                             "as a fraction (default: %(default)s)")
+    args = parser.parse_args()
+
+    report = run(args.filter, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    for name, reason in report["skipped"].items():
+        print("Skipped %s: %s" % (name, reason), file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(report, baseline, args.threshold)
+        for name, before, after in slower:
+            print("REGRESSION %s: %.6f ms -> %.6f ms"
+                  % (name, before * 1000, after * 1000), file=sys.stderr)
+        if slower:
+            sys.exit(1)
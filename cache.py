@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+A small on-disk cache (an sqlite database) for data that is expensive to
+compute and that rarely changes between runs.
+"""
+
+import sqlite3
+import threading
+
+CACHE_FILE = "cache.db"
+
+SCHEMA = """
+create table if not exists number_of_rows (
+        pagename text primary key,
+        revid integer not null,
+        -- null if the page has no full timeline table
+        number_of_rows integer
+);
+
+create table if not exists wp_monthly_pageviews (
+        pagename text not null,
+        -- YYYYMM
+        month text not null,
+        views integer not null,
+        primary key (pagename, month)
+);
+
+-- Google Analytics pageviews by normalized page path (see
+-- ga4_pageviews_fetch.normalized_path) and month
+create table if not exists ga_monthly_pageviews (
+        page_path text not null,
+        -- YYYYMM
+        month text not null,
+        views integer not null,
+        primary key (page_path, month)
+);
+
+-- Months whose Google Analytics pageviews have all been fetched
+create table if not exists ga_fetched_months (
+        month text primary key
+);
+
+-- The timelines on the wiki and their latest revisions, as of the time in
+-- manifest_updated (see proc.incremental_page_revisions)
+create table if not exists manifest (
+        pagename text primary key,
+        revid integer,
+        -- MediaWiki timestamp of the latest revision
+        timestamp text
+);
+
+create table if not exists manifest_updated (
+        -- Always 0, so there is only one row
+        id integer primary key check (id = 0),
+        -- MediaWiki timestamp
+        updated text not null
+);
+
+-- Rows of the table computed by a run of proc.py that hasn't finished yet, so
+-- that they don't need to be computed again if it is restarted (see
+-- proc.checkpointed_row)
+create table if not exists checkpoints (
+        -- The month of the run, YYYYMM
+        run text not null,
+        pagename text not null,
+        -- The revision the row was computed for
+        revid integer,
+        -- The row as JSON
+        data text not null,
+        primary key (run, pagename)
+);
+
+-- Results computed from some input that is expensive to process, kept as
+-- long as the input is unchanged (as identified by key, e.g. a checksum)
+create table if not exists snapshots (
+        name text primary key,
+        key text not null,
+        data text not null
+);
+"""
+
+_lock = threading.Lock()
+_conn = None
+
+
+def _connection():
+    # The connection is shared between the threads of proc.write_csv, which is
+    # fine as long as every use of it holds _lock.
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+        _conn.executescript(SCHEMA)
+    return _conn
+
+
+def get_number_of_rows(pagename, revid):
+    """
+    Return the cached number of rows for revision revid of pagename as a pair
+    (found, number_of_rows). The number of rows is "" if the page had no full
+    timeline, like proc.number_of_rows.
+    """
+    with _lock:
+        row = _connection().execute(
+                "select number_of_rows from number_of_rows "
+                "where pagename = ? and revid = ?", (pagename, revid)).fetchone()
+    if row is None:
+        return (False, None)
+    return (True, "" if row[0] is None else row[0])
+
+
+def set_number_of_rows(pagename, revid, number_of_rows):
+    """Remember the number of rows for revision revid of pagename. Only the
+    latest revision of each page is kept."""
+    with _lock:
+        conn = _connection()
+        conn.execute("insert or replace into number_of_rows "
+                     "(pagename, revid, number_of_rows) values (?, ?, ?)",
+                     (pagename, revid,
+                      None if number_of_rows == "" else number_of_rows))
+        conn.commit()
+
+
+def get_wp_monthly_pageviews(pagename):
+    """Return the cached monthly Wikipedia pageviews of pagename as a dict
+    mapping YYYYMM strings to pageviews."""
+    with _lock:
+        rows = _connection().execute(
+                "select month, views from wp_monthly_pageviews "
+                "where pagename = ?", (pagename,)).fetchall()
+    return dict(rows)
+
+
+def set_wp_monthly_pageviews(pagename, monthly_views):
+    """Remember the Wikipedia pageviews of pagename for each month in the dict
+    monthly_views."""
+    with _lock:
+        conn = _connection()
+        conn.executemany("insert or replace into wp_monthly_pageviews "
+                         "(pagename, month, views) values (?, ?, ?)",
+                         [(pagename, month, views)
+                          for month, views in monthly_views.items()])
+        conn.commit()
+
+
+def has_wp_monthly_pageviews(pagenames, month):
+    """Return True if the Wikipedia pageviews of every page in pagenames are
+    cached for month (a YYYYMM string)."""
+    pagenames = set(pagenames)
+    with _lock:
+        rows = _connection().execute(
+                "select pagename from wp_monthly_pageviews where month = ?",
+                (month,)).fetchall()
+    return pagenames <= {pagename for (pagename,) in rows}
+
+
+def get_ga_fetched_months():
+    """Return the set of months (YYYYMM strings) whose Google Analytics
+    pageviews are all in the cache."""
+    with _lock:
+        rows = _connection().execute(
+                "select month from ga_fetched_months").fetchall()
+    return {month for (month,) in rows}
+
+
+def set_ga_monthly_pageviews(monthly_views, months):
+    """Store the Google Analytics pageviews in monthly_views, a dict mapping
+    (page_path, month) pairs to pageviews, and record that all pageviews for
+    months have now been fetched."""
+    with _lock:
+        conn = _connection()
+        conn.executemany("insert or replace into ga_monthly_pageviews "
+                         "(page_path, month, views) values (?, ?, ?)",
+                         [(path, month, views)
+                          for (path, month), views in monthly_views.items()])
+        conn.executemany("insert or replace into ga_fetched_months (month) "
+                         "values (?)", [(month,) for month in months])
+        conn.commit()
+
+
+def get_ga_window_pageviews(months):
+    """Return a list of (page_path, pageviews) pairs, with each path's total
+    Google Analytics pageviews over months."""
+    months = list(months)
+    with _lock:
+        return _connection().execute(
+                "select page_path, sum(views) from ga_monthly_pageviews "
+                "where month in (%s) group by page_path"
+                % ", ".join("?" * len(months)), months).fetchall()
+
+
+def get_ga_monthly_pageviews(page_path):
+    """Return the cached monthly Google Analytics pageviews of page_path as a
+    dict mapping YYYYMM strings to pageviews."""
+    with _lock:
+        rows = _connection().execute(
+                "select month, views from ga_monthly_pageviews "
+                "where page_path = ?", (page_path,)).fetchall()
+    return dict(rows)
+
+
+def get_manifest():
+    """Return the saved manifest as a pair (updated, pages), where pages is a
+    dict like the one proc.page_revisions returns and updated is the
+    MediaWiki timestamp it is as of, or None if no manifest has been
+    saved."""
+    with _lock:
+        conn = _connection()
+        row = conn.execute("select updated from manifest_updated").fetchone()
+        rows = conn.execute(
+                "select pagename, revid, timestamp from manifest").fetchall()
+    if row is None:
+        return (None, {})
+    return (row[0], {pagename: {"revid": revid, "timestamp": timestamp}
+                     for pagename, revid, timestamp in rows})
+
+
+def set_manifest(updated, pages):
+    """Replace the saved manifest with pages (a dict like the one
+    proc.page_revisions returns), as of the MediaWiki timestamp updated."""
+    with _lock:
+        conn = _connection()
+        conn.execute("delete from manifest")
+        conn.executemany("insert into manifest (pagename, revid, timestamp) "
+                         "values (?, ?, ?)",
+                         [(pagename, page["revid"], page["timestamp"])
+                          for pagename, page in pages.items()])
+        conn.execute("insert or replace into manifest_updated (id, updated) "
+                     "values (0, ?)", (updated,))
+        conn.commit()
+
+
+def get_checkpoint(run, pagename, revid):
+    """Return the row saved for pagename by run, or None if there is none or
+    it was computed for a revision other than revid."""
+    with _lock:
+        row = _connection().execute(
+                "select data from checkpoints "
+                "where run = ? and pagename = ? and revid is ?",
+                (run, pagename, revid)).fetchone()
+    return row[0] if row else None
+
+
+def set_checkpoint(run, pagename, revid, data):
+    with _lock:
+        conn = _connection()
+        conn.execute("insert or replace into checkpoints "
+                     "(run, pagename, revid, data) values (?, ?, ?, ?)",
+                     (run, pagename, revid, data))
+        conn.commit()
+
+
+def clear_checkpoints(keep_run=None):
+    """Forget the rows saved by every run other than keep_run."""
+    with _lock:
+        conn = _connection()
+        conn.execute("delete from checkpoints where run is not ?", (keep_run,))
+        conn.commit()
+
+
+def get_snapshot(name, key):
+    """Return the data saved as snapshot name, or None if there is none or it
+    was saved under a different key."""
+    with _lock:
+        row = _connection().execute(
+                "select data from snapshots where name = ? and key = ?",
+                (name, key)).fetchone()
+    return row[0] if row else None
+
+
+def set_snapshot(name, key, data):
+    with _lock:
+        conn = _connection()
+        conn.execute("insert or replace into snapshots (name, key, data) "
+                     "values (?, ?, ?)", (name, key, data))
+        conn.commit()
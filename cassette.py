@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Record every HTTP response and database result of a run of proc.py to a
+"cassette" file, so that later runs can replay them without touching the
+network or MySQL. This is useful when working on how the data is aggregated
+or rendered, and gives repeatable inputs for timing the scripts.
+
+A cassette is a gzipped JSON file. HTTP responses are keyed by URL and query
+parameters (not headers or cookies), and database results by the SQL text.
+The date of the recording is saved too, and today() returns it while
+replaying, so that date ranges (and hence the requests made) come out the
+same as when the cassette was recorded.
+"""
+
+import base64
+import datetime
+import decimal
+import gzip
+import json
+import threading
+import urllib.parse
+
+RECORD = "record"
+REPLAY = "replay"
+
+MODE = None
+PATH = None
+
+_lock = threading.Lock()
+_data = {"date": None, "http": {}, "sql": {}}
+
+
+def start(path, mode):
+    """Start recording to, or replaying from, the cassette at path."""
+    global MODE, PATH
+    MODE = mode
+    PATH = path
+    if mode == REPLAY:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            _data.update(json.load(f))
+    else:
+        _data.update({"date": datetime.date.today().isoformat(),
+                      "http": {}, "sql": {}})
+
+
+def save():
+    """Write out the cassette being recorded (does nothing when replaying)."""
+    if MODE != RECORD:
+        return
+    with _lock:
+        with gzip.open(PATH, "wt", encoding="utf-8") as f:
+            json.dump(_data, f, sort_keys=True, separators=(",", ":"))
+
+
+def recording():
+    return MODE == RECORD
+
+
+def replaying():
+    return MODE == REPLAY
+
+
+def today():
+    """Today's date, or the date the cassette was recorded when replaying."""
+    if MODE == REPLAY and _data.get("date"):
+        return datetime.date.fromisoformat(_data["date"])
+    return datetime.date.today()
+
+
+def request_key(url, params=None):
+    if not params:
+        return url
+    return url + "?" + urllib.parse.urlencode(sorted(
+        (str(k), str(v)) for k, v in params.items()))
+
+
+def record_response(url, params, response):
+    entry = {"status": response.status_code,
+             "headers": dict(response.headers),
+             "url": response.url}
+    try:
+        entry["text"] = response.content.decode("utf-8")
+    except UnicodeDecodeError:
+        entry["base64"] = base64.b64encode(response.content).decode("ascii")
+    # Content-Encoding no longer applies, as the body is stored decoded
+    entry["headers"].pop("Content-Encoding", None)
+    with _lock:
+        _data["http"][request_key(url, params)] = entry
+
+
+def replay_response(url, params):
+    """Return a requests.Response for the recorded response to url with
+    params. Raises KeyError if the request was never recorded."""
+    import requests
+
+    key = request_key(url, params)
+    with _lock:
+        entry = _data["http"].get(key)
+    if entry is None:
+        raise KeyError("No recorded response in %s for %s" % (PATH, key))
+    response = requests.Response()
+    response.status_code = entry["status"]
+    response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+    response.url = entry["url"]
+    if "text" in entry:
+        response._content = entry["text"].encode("utf-8")
+        response.encoding = "utf-8"
+    else:
+        response._content = base64.b64decode(entry["base64"])
+    return response
+
+
+def _encode_value(x):
+    # Values that come back from MySQL but that JSON doesn't have
+    if isinstance(x, decimal.Decimal):
+        return {"decimal": str(x)}
+    if isinstance(x, datetime.datetime):
+        return {"datetime": x.isoformat()}
+    if isinstance(x, datetime.date):
+        return {"date": x.isoformat()}
+    return x
+
+
+def _decode_value(x):
+    if isinstance(x, dict):
+        if "decimal" in x:
+            return decimal.Decimal(x["decimal"])
+        if "datetime" in x:
+            return datetime.datetime.fromisoformat(x["datetime"])
+        if "date" in x:
+            return datetime.date.fromisoformat(x["date"])
+    return x
+
+
+def record_rows(sql, rows):
+    with _lock:
+        _data["sql"][sql] = [[_encode_value(x) for x in row] for row in rows]
+
+
+def replay_rows(sql):
+    """Return the recorded rows for the SQL query sql. Raises KeyError if the
+    query was never recorded."""
+    with _lock:
+        rows = _data["sql"].get(sql)
+    if rows is None:
+        raise KeyError("No recorded result in %s for %s" % (PATH, sql))
+    return [tuple(_decode_value(x) for x in row) for row in rows]
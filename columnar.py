@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+A compact, typed, column-oriented file for the table data that proc.py hands
+to print_table.py, as an alternative to front_page_table_data.csv that
+doesn't have to be parsed again.
+
+Each field in util.fieldnames is stored as one array, with the type given in
+util.fieldtypes:
+
+    "int"    64-bit integers; -1 stands for a blank value
+    "float"  64-bit floats
+    "month"  32-bit month ordinals (year * 12 + month - 1, so that sorting
+             them sorts the months); -1 stands for a blank month
+    "str"    32-bit indexes into a table of the distinct strings in the file,
+             so strings repeated across rows and columns (topics, months,
+             contributor lists) are stored once
+
+The file starts with MAGIC, then a little-endian 32-bit length and a JSON
+header of that length giving the number of rows and the byte offset of each
+array (counting from the first array); the arrays follow, each starting at a
+multiple of 8 bytes, in the byte order named in the header. read_columns
+memory-maps the file and returns the numeric arrays as views into it.
+
+Run as a script to convert a columnar file back to CSV:
+
+    ./columnar.py table.columnar > front_page_table_data.csv
+"""
+
+import array
+import csv
+import datetime
+import json
+import mmap
+import struct
+import sys
+
+import util
+
+MAGIC = b"TLCOL1\n"
+
+_TYPECODES = {"int": "q", "float": "d", "month": "i", "str": "i"}
+
+_MONTH_FORMAT = "%B %Y"
+
+
+def month_ordinal(month):
+    """Turn a month like "May 2023" into its ordinal, or -1 if it is
+    blank."""
+    if not month:
+        return -1
+    d = datetime.datetime.strptime(month, _MONTH_FORMAT)
+    return d.year * 12 + d.month - 1
+
+
+def ordinal_month(ordinal):
+    """The inverse of month_ordinal."""
+    if ordinal < 0:
+        return ""
+    year, month = divmod(ordinal, 12)
+    return datetime.date(year, month + 1, 1).strftime(_MONTH_FORMAT)
+
+
+def _pad(f, length):
+    # Pad what was just written (length bytes) to a multiple of 8 bytes
+    f.write(b"\0" * (-length % 8))
+
+
+def write(path, rows):
+    """Write rows (dicts with the keys in util.fieldnames, with either typed
+    or string values, as proc.table_row returns them) to path."""
+    rows = list(rows)
+    strings = {}
+    columns = []
+    for name in util.fieldnames:
+        kind = util.fieldtypes[name]
+        values = [row[name] for row in rows]
+        if kind == "int":
+            data = [-1 if v is None or v == "" else int(v) for v in values]
+        elif kind == "float":
+            data = [float(v) for v in values]
+        elif kind == "month":
+            data = [month_ordinal(v) for v in values]
+        else:
+            data = [strings.setdefault(v or "", len(strings)) for v in values]
+        columns.append((name, kind, array.array(_TYPECODES[kind], data)))
+
+    # The string table is the offsets of each string in a blob of UTF-8, with
+    # one more offset at the end
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = array.array("q", [0])
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    blob = b"".join(encoded)
+
+    # Offsets in the header are from the start of the data, which is the
+    # first multiple of 8 bytes after the header
+    sections = [offsets.tobytes(), blob] + [a.tobytes() for _, _, a in columns]
+    section_offsets = []
+    position = 0
+    for section in sections:
+        section_offsets.append(position)
+        position += len(section)
+        position += -position % 8
+    header = {"rows": len(rows), "byteorder": sys.byteorder,
+              "strings": {"count": len(encoded),
+                          "offsets": section_offsets[0],
+                          "data": section_offsets[1]},
+              "columns": [{"name": name, "type": kind, "offset": offset}
+                          for (name, kind, _), offset
+                          in zip(columns, section_offsets[2:])]}
+    encoded_header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(encoded_header)))
+        f.write(encoded_header)
+        _pad(f, len(MAGIC) + 4 + len(encoded_header))
+        for section in sections:
+            f.write(section)
+            _pad(f, len(section))
+
+
+def _array(buffer, offset, typecode, count, byteorder):
+    view = memoryview(buffer)[offset:offset + count * array.array(typecode).itemsize]
+    if byteorder == sys.byteorder:
+        return view.cast(typecode)
+    # Written on a machine with the other byte order, so it has to be copied
+    a = array.array(typecode, view.tobytes())
+    a.byteswap()
+    return a
+
+
+def read_columns(path):
+    """
+    Return (number of rows, columns) for the columnar file at path, where
+    columns maps each field name to a sequence of its values: memoryviews
+    into the mapped file for numeric and month fields (blank values are -1,
+    months are ordinals) and lists of strings for string fields.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a columnar table file" % path)
+    (length,) = struct.unpack_from("<I", buffer, len(MAGIC))
+    start = len(MAGIC) + 4
+    header = json.loads(buffer[start:start + length].decode("utf-8"))
+    base = start + length
+    base += -base % 8
+    n = header["rows"]
+    byteorder = header["byteorder"]
+
+    table = header["strings"]
+    offsets = _array(buffer, base + table["offsets"], "q", table["count"] + 1,
+                     byteorder)
+    data = base + table["data"]
+    strings = [buffer[data + offsets[i]:data + offsets[i + 1]].decode("utf-8")
+               for i in range(table["count"])]
+
+    columns = {}
+    for column in header["columns"]:
+        kind = column["type"]
+        values = _array(buffer, base + column["offset"], _TYPECODES[kind], n,
+                        byteorder)
+        if kind == "str":
+            values = [strings[i] for i in values]
+        columns[column["name"]] = values
+    return (n, columns)
+
+
+def read_rows(path):
+    """Return the rows of the columnar file at path as dicts, typed like
+    print_table.load_rows returns them (blank numbers of rows are None and
+    months are strings like "May 2023")."""
+    n, columns = read_columns(path)
+    converted = {}
+    for name, values in columns.items():
+        kind = util.fieldtypes[name]
+        if kind == "int":
+            converted[name] = [None if v < 0 else v for v in values]
+        elif kind == "month":
+            converted[name] = [ordinal_month(v) for v in values]
+        else:
+            converted[name] = list(values)
+    return [{name: converted[name][i] for name in util.fieldnames}
+            for i in range(n)]
+
+
+def write_csv(path, csvfile):
+    """
+    Export the columnar file at path as CSV to csvfile, in the same form
+    proc.py writes it.
+
+    Payments are stored as floats, so their formatting is put back the way
+    proc.py writes it: two decimals (like the Decimals from contractwork),
+    or 0.0 for a page without a payment. A page whose payments add up to
+    exactly zero also comes back as 0.0, where proc.py would write 0.00.
+    """
+    writer = csv.DictWriter(csvfile, fieldnames=util.fieldnames)
+    writer.writeheader()
+    for row in read_rows(path):
+        if row["number_of_rows"] is None:
+            row["number_of_rows"] = ""
+        if row["payment"]:
+            row["payment"] = "%.2f" % row["payment"]
+        writer.writerow(row)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: %s FILE" % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+    write_csv(sys.argv[1], sys.stdout)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+"""
+Payment data from Vipul Naik's contractwork database
+(https://github.com/vipulnaik/contractwork).
+
+proc.py needs two aggregates of the tasks table: for each task receptacle
+(timeline), the total payment, topic and first completion date; and for each
+receptacle and worker, the total payment. Both are computed from one grouping
+by receptacle and worker (see COMBINED_QUERY and rollup), and the result is
+saved in the cache along with a key that changes when the data changes. Both
+sources below return them in the same shape, namely a pair (receptacle_rows,
+worker_rows) where
+
+    receptacle_rows = [(task_receptacle, total_payment, topic, first_completion_date), ...]
+    worker_rows = [(task_receptacle, worker, total_payment), ...]
+
+mysql_aggregates runs queries against a MySQL database that has been loaded
+from the contractwork repository, while tasks_sql_aggregates reads the tasks
+SQL dump in the repository directly, so the database doesn't need to be
+rebuilt (or even installed) for each run.
+"""
+
+import datetime
+import decimal
+import hashlib
+import json
+import re
+from pathlib import Path
+
+import cache
+import cassette
+
+# Both aggregates come from this one query, whose rows are rolled up per
+# receptacle in rollup(). For it to be a single index scan rather than a scan
+# and a sort, the tasks table needs an index on (task_receptacle, worker):
+#
+#     create index tasks_receptacle_worker on tasks (task_receptacle, worker);
+COMBINED_QUERY = """select task_receptacle, worker, sum(payment), min(topic),
+                           min(completion_date)
+                    from tasks group by task_receptacle, worker"""
+
+# The columns that identify the current contents of the tasks table, so that
+# the result of COMBINED_QUERY can be reused until the table is reloaded or
+# changed: the primary key, and any column that MySQL updates itself when a
+# row changes (... ON UPDATE CURRENT_TIMESTAMP). The key is then the number of
+# rows and the largest value of each of those columns (see table_key_query),
+# which MySQL gets from the smallest index and the ends of the indexes rather
+# than by reading every row, as CHECKSUM TABLE would. (The update_time and
+# table_rows in information_schema.tables won't do: table_rows is only an
+# estimate for InnoDB, and MySQL 8 caches both for up to a day.)
+KEY_COLUMNS_QUERY = """select column_name, column_key, extra
+                       from information_schema.columns
+                       where table_schema = database() and table_name = 'tasks'
+                       order by ordinal_position"""
+
+
+def table_key_query():
+    """
+    Return the query whose result is used as the key of the snapshot of
+    COMBINED_QUERY. If the tasks table has no column that is updated along
+    with its rows, an edit that keeps the number of rows and the largest
+    primary key the same isn't noticed. After such an edit, delete the
+    contractwork-mysql row from the snapshots table of the cache, or use
+    tasks_sql_aggregates, which checksums the dump itself.
+    """
+    columns = [name for name, column_key, extra in mysql_rows(KEY_COLUMNS_QUERY)
+               if column_key == "PRI" or "on update" in (extra or "").lower()]
+    return "select count(*)%s from tasks" % "".join(
+            ", max(`%s`)" % name for name in columns)
+
+
+def mysql_rows(sql):
+    """Run sql on the contractwork database and return all of the resulting
+    rows. When a cassette is being replayed, the recorded rows are returned
+    without connecting to the database."""
+    if cassette.replaying():
+        return cassette.replay_rows(sql)
+    import mysql.connector
+
+    if Path("/etc/fedora-release").exists():
+        cnx = mysql.connector.connect(user='issa', database='contractwork',
+                                      unix_socket='/var/lib/mysql/mysql.sock')
+    else:
+        cnx = mysql.connector.connect(user='issa', database='contractwork')
+    cursor = cnx.cursor()
+    cursor.execute(sql)
+    rows = cursor.fetchall()
+    cursor.close()
+    cnx.close()
+    if cassette.recording():
+        cassette.record_rows(sql, rows)
+    return rows
+
+
+def mysql_aggregates():
+    """Compute the aggregates from the contractwork database, reusing the
+    result of an earlier run if the tasks table hasn't changed since."""
+    key = repr(mysql_rows(table_key_query()))
+    data = cache.get_snapshot("contractwork-mysql", key)
+    if data is not None:
+        return decode_aggregates(data)
+    aggregates = rollup(mysql_rows(COMBINED_QUERY))
+    cache.set_snapshot("contractwork-mysql", key, encode_aggregates(aggregates))
+    return aggregates
+
+
+# Reading the SQL dump
+
+# Statements are split at semicolons that are outside of quotes and comments
+_QUOTES = "'\"`"
+
+_TOKEN = re.compile(r"""\s*(?:
+      '((?:[^'\\]|\\.|'')*)'                        # single-quoted string
+    | "((?:[^"\\]|\\.|"")*)"                        # double-quoted string
+    | ([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)   # number
+    | ([(),])                                       # punctuation
+    | (\w+)                                         # NULL and other keywords
+    )""", re.VERBOSE | re.DOTALL)
+
+_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t",
+            "Z": "\x1a"}
+
+_INSERT = re.compile(
+        r"\s*insert\s+(?:ignore\s+)?into\s+`?tasks`?\s*(?:\(([^)]*)\))?\s*values\s*",
+        re.IGNORECASE)
+_CREATE = re.compile(r"\s*create\s+table\s+(?:if\s+not\s+exists\s+)?`?tasks`?\s*\(",
+                     re.IGNORECASE)
+_COLUMN_DEFINITION = re.compile(r"^\s*`?(\w+)`?\s+(\w+)(?:\(\s*\d+\s*,\s*(\d+)\s*\))?",
+                                re.IGNORECASE)
+_NOT_COLUMNS = {"primary", "key", "unique", "index", "constraint", "foreign",
+                "fulltext", "check"}
+
+
+def statements(f):
+    """Yield the SQL statements in the file f one at a time, without
+    comments."""
+    statement = []
+    quote = None
+    block_comment = False
+    for line in f:
+        i = 0
+        n = len(line)
+        start = 0
+        while i < n:
+            c = line[i]
+            if block_comment:
+                if line.startswith("*/", i):
+                    block_comment = False
+                    i += 2
+                    start = i
+                    continue
+            elif quote:
+                if c == "\\" and quote != "`":
+                    i += 2
+                    continue
+                if c == quote:
+                    quote = None
+            elif c in _QUOTES:
+                quote = c
+            elif c == "#" or line.startswith("-- ", i) or \
+                    line.startswith("--\n", i):
+                statement.append(line[start:i])
+                start = n
+                break
+            elif line.startswith("/*", i):
+                statement.append(line[start:i])
+                block_comment = True
+                i += 2
+                continue
+            elif c == ";":
+                statement.append(line[start:i])
+                yield "".join(statement)
+                statement = []
+                start = i + 1
+            i += 1
+        if not block_comment:
+            statement.append(line[start:])
+    rest = "".join(statement)
+    if rest.strip():
+        yield rest
+
+
+def _unescape(s, quote):
+    s = s.replace(quote * 2, quote)
+    return re.sub(r"\\(.)", lambda m: _ESCAPES.get(m.group(1), m.group(1)), s,
+                  flags=re.DOTALL)
+
+
+def values(text):
+    """Parse the text after VALUES in an INSERT statement, and yield each
+    tuple of values as a list."""
+    row = None
+    for m in _TOKEN.finditer(text):
+        single, double, number, punctuation, word = m.groups()
+        if punctuation == "(":
+            row = []
+        elif punctuation == ")":
+            yield row
+            row = None
+        elif row is None:
+            continue
+        elif single is not None:
+            row.append(_unescape(single, "'"))
+        elif double is not None:
+            row.append(_unescape(double, '"'))
+        elif number is not None:
+            row.append(decimal.Decimal(number))
+        elif word is not None:
+            row.append(None if word.lower() == "null" else word)
+
+
+def tasks_rows(f):
+    """
+    Yield a dict for each row inserted into the tasks table by the SQL dump
+    f. The column names come from the INSERT statement, or else from the
+    CREATE TABLE statement for tasks. The number of decimal places of the
+    payment column (2 if the dump doesn't say) is stored under the key
+    "_payment_scale".
+    """
+    columns = None
+    payment_scale = 2
+    for statement in statements(f):
+        m = _CREATE.match(statement)
+        if m:
+            columns = []
+            for definition in statement[m.end():].split("\n"):
+                d = _COLUMN_DEFINITION.match(definition)
+                if d and d.group(1).lower() not in _NOT_COLUMNS:
+                    columns.append(d.group(1))
+                    if d.group(1) == "payment" and d.group(3):
+                        payment_scale = int(d.group(3))
+            continue
+        m = _INSERT.match(statement)
+        if not m:
+            continue
+        if m.group(1):
+            names = [c.strip(" `\n\t") for c in m.group(1).split(",")]
+        else:
+            names = columns
+        if not names:
+            raise ValueError("INSERT into tasks without column names, and no "
+                             "CREATE TABLE for tasks before it")
+        for row in values(statement[m.end():]):
+            row = dict(zip(names, row))
+            row["_payment_scale"] = payment_scale
+            yield row
+
+
+def _date(x):
+    if x is None or isinstance(x, datetime.date):
+        return x
+    return datetime.date.fromisoformat(str(x)[:10])
+
+
+def _add(a, b):
+    # Like SQL's SUM, ignoring NULLs
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _min(a, b, key=None):
+    # Like SQL's MIN, ignoring NULLs
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if key:
+        return a if key(a) <= key(b) else b
+    return min(a, b)
+
+
+def rollup(rows):
+    """
+    Turn rows of (task_receptacle, worker, total_payment, topic,
+    first_completion_date), one per receptacle and worker, into the pair
+    (receptacle_rows, worker_rows). Topics are compared without regard to
+    case, like MySQL's default collation does.
+    """
+    receptacles = {}
+    worker_rows = []
+    for receptacle, worker, payment, topic, completion_date in rows:
+        total, min_topic, first_date = receptacles.get(receptacle,
+                                                       (None, None, None))
+        receptacles[receptacle] = (
+                _add(total, payment),
+                _min(min_topic, topic, key=str.casefold),
+                _min(first_date, _date(completion_date)))
+        worker_rows.append((receptacle, worker, payment))
+    receptacle_rows = [(receptacle,) + aggregates
+                       for receptacle, aggregates in receptacles.items()]
+    return (receptacle_rows, worker_rows)
+
+
+def aggregate(rows):
+    """Compute, in one pass over the task rows, what COMBINED_QUERY computes
+    in MySQL, and roll it up."""
+    groups = {}
+    for row in rows:
+        payment = row.get("payment")
+        if payment is not None:
+            quantum = decimal.Decimal(1).scaleb(-row["_payment_scale"])
+            payment = decimal.Decimal(payment).quantize(
+                    quantum, rounding=decimal.ROUND_HALF_UP)
+        key = (row.get("task_receptacle"), row.get("worker"))
+        total, topic, first_date = groups.get(key, (None, None, None))
+        groups[key] = (_add(total, payment),
+                       _min(topic, row.get("topic"), key=str.casefold),
+                       _min(first_date, _date(row.get("completion_date"))))
+    # MySQL returns groups in order of the group-by columns
+    combined_rows = sorted((key + aggregates for key, aggregates in groups.items()),
+                           key=lambda x: ((x[0] or "").casefold(),
+                                          (x[1] or "").casefold()))
+    return rollup(combined_rows)
+
+
+def _encode(x):
+    if isinstance(x, decimal.Decimal):
+        return {"decimal": str(x)}
+    if isinstance(x, datetime.date):
+        return {"date": x.isoformat()}
+    return x
+
+
+def _decode(x):
+    if isinstance(x, dict):
+        if "decimal" in x:
+            return decimal.Decimal(x["decimal"])
+        return datetime.date.fromisoformat(x["date"])
+    return x
+
+
+def encode_aggregates(aggregates):
+    """Turn a pair of aggregate row lists into a JSON string."""
+    return json.dumps([[[_encode(x) for x in row] for row in rows]
+                       for rows in aggregates])
+
+
+def decode_aggregates(data):
+    return tuple([tuple(_decode(x) for x in row) for row in rows]
+                 for rows in json.loads(data))
+
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tasks_sql_aggregates(path):
+    """Compute the aggregates from the tasks SQL dump at path, reusing the
+    result of an earlier run if the dump hasn't changed since."""
+    checksum = file_checksum(path)
+    data = cache.get_snapshot("contractwork", checksum)
+    if data is not None:
+        return decode_aggregates(data)
+    with open(path, encoding="utf-8") as f:
+        aggregates = aggregate(tasks_rows(f))
+    cache.set_snapshot("contractwork", checksum, encode_aggregates(aggregates))
+    return aggregates
+
+
+# A small tasks dump for check(), in the form mysqldump writes
+CHECK_SQL = """-- MySQL dump
+DROP TABLE IF EXISTS `tasks`;
+CREATE TABLE `tasks` (
+  `task_id` int(11) NOT NULL AUTO_INCREMENT,
+  `worker` varchar(100) NOT NULL,
+  `task_receptacle` varchar(200) DEFAULT NULL,
+  `topic` varchar(100) DEFAULT NULL,
+  `payment` decimal(10,2) DEFAULT NULL,
+  `completion_date` date DEFAULT NULL,
+  PRIMARY KEY (`task_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO `tasks` VALUES (1,'Sebastian','Timeline of Airbnb','Sharing economy',100.00,'2016-03-04'),
+(2,'Issa Rice','Timeline of Airbnb','sharing economy',50.5,'2015-11-20'),
+(3,'Sebastian','Timeline of Airbnb','Sharing economy',25.00,NULL),
+(4,'Issa Rice','Timeline of \\'quoted\\' things; really','Miscellaneous',10.00,'2017-01-02');
+"""
+
+
+def check():
+    """Aggregate CHECK_SQL through proc.contractwork_data, with the cache in
+    memory, and return a list of the ways the result is wrong."""
+    import tempfile
+
+    import proc
+
+    cache.CACHE_FILE = ":memory:"
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "tasks.sql"
+        path.write_text(CHECK_SQL, encoding="utf-8")
+        proc.CONTRACTWORK_SQL = str(path)
+        articles, principal_contributors = proc.contractwork_data()
+        # The second time round comes from the snapshot
+        from_snapshot = tasks_sql_aggregates(str(path))
+        if from_snapshot != aggregate(tasks_rows(CHECK_SQL.splitlines(True))):
+            return ["the snapshot differs from aggregating the dump"]
+
+    D = decimal.Decimal
+    expected_articles = {
+        "Timeline of Airbnb": {"payment": D("175.50"),
+                               "topic": "sharing economy",
+                               "creation_month": "November 2015"},
+        "Timeline of 'quoted' things; really": {
+            "payment": D("10.00"), "topic": "Miscellaneous",
+            "creation_month": "January 2017"},
+    }
+    expected_contributors = {
+        "Timeline of Airbnb": [("Issa Rice", D("50.50")),
+                               ("Sebastian", D("125.00"))],
+        "Timeline of 'quoted' things; really": [("Issa Rice", D("10.00"))],
+    }
+    problems = []
+    for title, expected in expected_articles.items():
+        if articles.get(title) != expected:
+            problems.append("articles[%r] is %r, expected %r"
+                            % (title, articles.get(title), expected))
+    for title in proc.NON_PAID_ARTICLES:
+        if title not in articles:
+            problems.append("%r is missing from articles" % title)
+    if principal_contributors != expected_contributors:
+        problems.append("principal_contributors is %r, expected %r"
+                        % (principal_contributors, expected_contributors))
+    return problems
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["--check"]:
+        problems = check()
+        for problem in problems:
+            print(problem)
+        print("ok" if not problems else "%d problems" % len(problems))
+        sys.exit(1 if problems else 0)
+    if len(sys.argv) != 2:
+        print("Usage: %s TASKS_SQL" % sys.argv[0], file=sys.stderr)
+        print("Aggregate the tasks SQL dump TASKS_SQL and save the result in "
+              "the cache, for proc.py --contractwork-sql to use.",
+              file=sys.stderr)
+        print("       %s --check" % sys.argv[0], file=sys.stderr)
+        print("Check that proc.py reads the payments in a small dump "
+              "correctly.", file=sys.stderr)
+        sys.exit(1)
+    receptacle_rows, worker_rows = tasks_sql_aggregates(sys.argv[1])
+    print("%d timelines, %d (timeline, worker) pairs"
+          % (len(receptacle_rows), len(worker_rows)))
@@ -1,77 +1,202 @@
 #!/usr/bin/env python3
 
+import argparse
 import datetime
 import sys
 # import mysql.connector
-import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import (
+    BatchRunReportsRequest,
+    BatchRunReportsResponse,
     DateRange,
     Dimension,
+    Filter,
+    FilterExpression,
+    FilterExpressionList,
     Metric,
     RunReportRequest,
+    RunReportResponse,
 )
 
+import cache
+import instrument
+import proc
+
 
 # KEY_FILE_LOCATION = sys.argv[1]
 KEY_FILE_LOCATION = "timelines-key.json"
 
+PROPERTY_ID = "364967470"
+
 LIMIT = 10000
 
+# The most reports that can go in one batchRunReports request
+BATCH_SIZE = 5
+
+# Number of report pages to fetch at the same time. GA4 allows at most 10
+# concurrent requests per property (see
+# https://developers.google.com/analytics/devguides/reporting/data/v1/quotas),
+# so stay well under that to leave room for anything else using the property.
+CONCURRENCY = 4
+
+# GA4 takes a day or two to finish processing a day's data, so the pageviews
+# of a month are only taken to be complete once this many days have passed
+# since it ended. Until then the month is fetched again on every run.
+GA_PROCESSING_DAYS = 3
+
+# Only ask GA for the paths of timeline articles. This is a bit broader than
+# what proc.ga_pageviews looks up (it also matches e.g. "/wiki/Timelines"),
+# and normalized_path takes care of the rest.
+TIMELINE_PATHS = FilterExpression(and_group=FilterExpressionList(expressions=[
+    FilterExpression(filter=Filter(
+        field_name="pagePath",
+        string_filter=Filter.StringFilter(
+            match_type=Filter.StringFilter.MatchType.BEGINS_WITH,
+            value="/wiki/"))),
+    FilterExpression(filter=Filter(
+        field_name="pagePath",
+        string_filter=Filter.StringFilter(
+            match_type=Filter.StringFilter.MatchType.CONTAINS,
+            value="timeline",
+            case_sensitive=False))),
+]))
+
 def quote(x):
     """CSV-quote x."""
     x = x.replace('"', '""')
     return '"' + x + '"'
 
 
-def main():
+def main(per_page_ranges=False, concurrency=CONCURRENCY, incremental=False):
     client = BetaAnalyticsDataClient.from_service_account_json(KEY_FILE_LOCATION)
 
-    # It would be ideal to use proc.pageviews_date_range in this script here,
-    # because even though the GA API will just get the pageviews for the entire
-    # valid period (thus it's no problem to specify a start date that is too
-    # early), some pages may nevertheless get a few pageviews from before they
-    # were fully created, and we ideally wouldn't want to count those
-    # pageviews. However, using proc.pageviews_date_range to get the exact
-    # valid range for each page's URL will require an API call for each URL and
-    # I haven't done the math to see if GA API's usage limits allow this.  But
-    # in any case, a page shouldn't be getting too many pageviews before it's
-    # been marked as created (since logged in views don't count), so doing
-    # things the easy way should not overestimate pageviews by very much (and
-    # if a page is more than a year old, will yield identical results).
+    if incremental:
+        # Keep the pageviews of each path for each month in the cache, and
+        # only ask GA about the months we don't have yet (normally just the
+        # last one). proc.py --ga-monthly-store then works out each page's
+        # average over its own date range from the stored months; ga.csv is
+        # still written (for the past year) for everything else.
+        start_date, end_date = window()
+        with instrument.stage("ga_fetch"):
+            update_monthly_store(client, PROPERTY_ID, start_date, end_date,
+                                 concurrency)
+        pageviews = cache.get_ga_window_pageviews(
+                proc.months_in_range(start_date, end_date))
+    elif per_page_ranges:
+        # Count each page's views only from its own proc.pageviews_date_range,
+        # so that views from before a page was marked as created are left
+        # out. Pages with the same range share a report, and the reports go
+        # BATCH_SIZE at a time in batchRunReports calls, so this takes only a
+        # handful of requests rather than one per page.
+        with instrument.stage("ga_fetch"):
+            pageviews = per_page_pageviews(client, PROPERTY_ID,
+                                           proc.articles())
+    else:
+        # Otherwise we do things the easy way and get the pageviews of every
+        # page over the whole past year. A page shouldn't be getting too many
+        # pageviews before it's been marked as created (since logged in views
+        # don't count), so this should not overestimate pageviews by very
+        # much (and if a page is more than a year old, will yield identical
+        # results).
+        start_date, end_date = window()
+        with instrument.stage("ga_fetch"):
+            pageviews = pageviews_for_project(client, PROPERTY_ID,
+                    start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
+                    concurrency)
+    print("page_path,pageviews")
+    for path, views in aggregated_pageviews(pageviews):
+        print(f"{quote(path)},{views}")
+
+
+def window():
+    """The dates from which to count pageviews: the past year, but not from
+    before GA4 has data."""
     today = datetime.date.today()
     start_date = max(datetime.date(today.year - 1, today.month, 1),
                      datetime.date(2023, 5, 1))
     # Stop getting pageviews at the last day of the previous month
     end_date = datetime.date(today.year, today.month, 1) - \
             datetime.timedelta(days=1)
+    return (start_date, end_date)
 
-    pageviews = pageviews_for_project(client, "364967470",
-            start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
-    print("page_path,pageviews")
-    for row in pageviews:
-        path, views = row
-        print(f"{quote(path)},{views}")
 
+def update_monthly_store(client, property_id, start_date, end_date,
+                         concurrency=CONCURRENCY):
+    """Fetch the monthly pageviews of each path for the months between
+    start_date and end_date that aren't in the cache yet, and store them.
+    Months that ended less than GA_PROCESSING_DAYS ago are stored but fetched
+    again next time, as GA may not have all of their pageviews yet."""
+    fetched = cache.get_ga_fetched_months()
+    missing = [month for month in proc.months_in_range(start_date, end_date)
+               if month not in fetched]
+    if not missing:
+        return
+    # One report for everything from the first to the last missing month
+    # (normally the last two months, as the one before last was still being
+    # processed by GA at the last run)
+    first = datetime.datetime.strptime(missing[0], "%Y%m").date()
+    last = datetime.datetime.strptime(missing[-1], "%Y%m").date()
+    last = min(end_date, (last + datetime.timedelta(days=31)).replace(day=1)
+               - datetime.timedelta(days=1))
+    rows = pageviews_for_project(client, property_id,
+                                 first.strftime("%Y-%m-%d"),
+                                 last.strftime("%Y-%m-%d"),
+                                 concurrency, by_month=True)
+    monthly_views = {}
+    for month, path, views in rows:
+        key = (normalized_path(path), month)
+        monthly_views[key] = monthly_views.get(key, 0) + views
+    # Don't record a month as fetched while GA may still be adding to it (run.sh
+    # runs on the first of the month, when last month isn't complete yet)
+    complete_before = datetime.date.today() - \
+            datetime.timedelta(days=GA_PROCESSING_DAYS)
+    complete = [month for month in proc.months_in_range(first, last)
+                if month_end(month) < complete_before]
+    cache.set_ga_monthly_pageviews(monthly_views, complete)
 
-def get_report(client, property_id, start_date, end_date, offset=0):
-    """Queries the Google Analytics 4 Data API v1."""
-    print("Doing PropertyID=%s [%s, %s] (offset: %s)" % (
-                property_id, start_date, end_date, offset), file=sys.stderr)
 
-    # For pagination, see
-    # https://developers.google.com/analytics/devguides/reporting/data/v1/basics#pagination
+def month_end(month):
+    """The last day of month, a YYYYMM string."""
+    start = datetime.datetime.strptime(month, "%Y%m").date()
+    return (start + datetime.timedelta(days=31)).replace(day=1) - \
+            datetime.timedelta(days=1)
+
 
-    request = RunReportRequest(
+def report_request(property_id, start_date, end_date, offset=0,
+                   dimension_filter=TIMELINE_PATHS, by_month=False):
+    # pagePath rather than pagePathPlusQueryString, so that GA adds up the
+    # views of the variants of a URL with different query strings for us
+    dimensions = [Dimension(name="pagePath")]
+    if by_month:
+        dimensions.insert(0, Dimension(name="yearMonth"))
+    return RunReportRequest(
         property=f"properties/{property_id}",
-        dimensions=[Dimension(name="pagePathPlusQueryString")],
+        dimensions=dimensions,
         metrics=[Metric(name="screenPageViews")],
         date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
+        dimension_filter=dimension_filter,
         offset=offset,
         limit=LIMIT,
     )
+
+
+def get_report(client, property_id, start_date, end_date, offset=0,
+               dimension_filter=TIMELINE_PATHS, by_month=False):
+    """Queries the Google Analytics 4 Data API v1."""
+    print("Doing PropertyID=%s [%s, %s] (offset: %s)" % (
+                property_id, start_date, end_date, offset), file=sys.stderr)
+
+    # For pagination, see
+    # https://developers.google.com/analytics/devguides/reporting/data/v1/basics#pagination
+    request = report_request(property_id, start_date, end_date, offset,
+                             dimension_filter, by_month)
+    instrument.count("requests")
     response = client.run_report(request)
+    instrument.count("bytes", len(RunReportResponse.serialize(response)))
+    instrument.count("rows", len(response.rows))
     return response
 
 
@@ -79,42 +204,173 @@ def extracted_pageviews(response):
     """Extract the GA response into a list of tuples containing pageviews data,
     e.g. [('/wiki/Timeline_of_ChatGPT', 2201),
           ('/wiki/Timeline_of_online_food_delivery', 1189),
-          ('/wiki/Timeline_of_OpenAI', 659), ...]."""
+          ('/wiki/Timeline_of_OpenAI', 659), ...].
+    For reports by month, the tuples start with the month, e.g.
+    ('202305', '/wiki/Timeline_of_ChatGPT', 1850)."""
     result = []
     for row in response.rows:
-        dimensions = row.dimension_values  # the pagepath
-        pagepath = dimensions[0].value
+        dimensions = row.dimension_values  # the pagepath (after the month)
         pageviews_values = row.metric_values
         assert len(pageviews_values) == 1, pageviews_values
         pageviews = int(pageviews_values[0].value)
-        result.append((pagepath, pageviews))
+        result.append(tuple(d.value for d in dimensions) + (pageviews,))
     return result
 
 
-def pageviews_for_project(client, property_id, start_date, end_date):
+def normalized_path(path):
+    """
+    Normalize a page path the way proc.ga_pageviews spells it, e.g.
+    "/wiki/timeline_of_Caf%C3%A9?foo" becomes "/wiki/Timeline_of_Café": the
+    query string and fragment are removed, percent-escapes are decoded,
+    spaces become underscores, and the first letter of the title is
+    capitalized (as MediaWiki does).
+    """
+    path = path.split("?", 1)[0].split("#", 1)[0]
+    path = urllib.parse.unquote(path).replace(" ", "_")
+    prefix = "/wiki/"
+    if path.startswith(prefix) and len(path) > len(prefix):
+        path = prefix + path[len(prefix)].upper() + path[len(prefix) + 1:]
+    return path
+
+
+def aggregated_pageviews(pageviews):
+    """Add up the pageviews of paths that normalize to the same path, and
+    return a list of (path, pageviews) tuples sorted by path."""
+    totals = {}
+    for path, views in pageviews:
+        path = normalized_path(path)
+        totals[path] = totals.get(path, 0) + views
+    return sorted(totals.items())
+
+
+def page_paths(pagename):
+    """The paths under which GA may have recorded views of pagename: as
+    proc.ga_pageviews spells it, and percent-encoded."""
+    path = "/wiki/" + pagename.replace(" ", "_")
+    return sorted({path, urllib.parse.quote(path, safe="/:,()!*'~@$;")})
+
+
+def pages_filter(pagenames):
+    """A filter for the paths of pagenames."""
+    return FilterExpression(filter=Filter(
+        field_name="pagePath",
+        in_list_filter=Filter.InListFilter(
+            values=[path for pagename in pagenames
+                    for path in page_paths(pagename)])))
+
+
+def pages_by_date_range(pagenames):
+    """Group pagenames by their proc.pageviews_date_range for GA4, returning
+    a dict mapping (start_date, end_date) pairs to lists of pagenames. Pages
+    without a valid range are left out."""
+    groups = {}
+    for pagename in pagenames:
+        start_date, end_date = proc.pageviews_date_range(pagename,
+                                                         destination="ga4")
+        if start_date and end_date and start_date <= end_date:
+            groups.setdefault((start_date, end_date), []).append(pagename)
+    return groups
+
+
+def per_page_pageviews(client, property_id, pagenames):
+    """Get the pageviews of each of pagenames over its own date range, with
+    one report per distinct date range, sent in batches of BATCH_SIZE."""
+    reports = [(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"),
+                pages_filter(pages))
+               for (start_date, end_date), pages
+               in sorted(pages_by_date_range(pagenames).items())]
+    result = []
+    for i in range(0, len(reports), BATCH_SIZE):
+        batch = reports[i:i + BATCH_SIZE]
+        print("Doing PropertyID=%s batch of %s reports [%s, %s] to [%s, %s]" % (
+                    property_id, len(batch), batch[0][0], batch[0][1],
+                    batch[-1][0], batch[-1][1]), file=sys.stderr)
+        request = BatchRunReportsRequest(
+            property=f"properties/{property_id}",
+            requests=[report_request(property_id, start_date, end_date,
+                                     dimension_filter=dimension_filter)
+                      for start_date, end_date, dimension_filter in batch],
+        )
+        instrument.count("requests")
+        response = client.batch_run_reports(request)
+        instrument.count("bytes",
+                         len(BatchRunReportsResponse.serialize(response)))
+        for (start_date, end_date, dimension_filter), report in \
+                zip(batch, response.reports):
+            instrument.count("rows", len(report.rows))
+            result.extend(extracted_pageviews(report))
+            # Each report has at most a few hundred paths, so this is only
+            # for safety
+            offset = LIMIT
+            while offset < report.row_count:
+                more = get_report(client, property_id, start_date, end_date,
+                                  offset, dimension_filter)
+                result.extend(extracted_pageviews(more))
+                offset += LIMIT
+    return result
+
+
+def pageviews_for_project(client, property_id, start_date, end_date,
+                          concurrency=CONCURRENCY, by_month=False):
+    """
+    Get the pageviews of every timeline path over the given dates (for each
+    month separately if by_month is true; see extracted_pageviews). The first
+    page of the report tells us how many rows there are in total, after which
+    the remaining pages are fetched concurrently (at most concurrency at a
+    time) and put back together in order.
+    """
     result = []
     if start_date > end_date:
         # This means we already have all the most recent data, so don't query
         return result
 
-    offset = 0
-    while True:
-        time.sleep(1)
-        response = get_report(client, property_id, start_date,
-                              end_date, offset)
-        result.extend(extracted_pageviews(response))
-        offset += LIMIT
-        if offset >= response.row_count:
-            # The comparison >= is the correct one here (not >) because
-            # the first row is considered row 0 according to
-            # https://developers.google.com/analytics/devguides/reporting/data/v1/rest/v1beta/properties/runReport#body.request_body.FIELDS.offset
-            # So e.g. if there are five rows, they will be rows 0,1,2,3,4, and
-            # if offset is >=5 then there will be no more rows to fetch. (I
-            # also empirically checked that this is the actual behavior of the
-            # API.)
-            break
+    def fetch(offset):
+        with instrument.stage("ga_report", offset):
+            return get_report(client, property_id, start_date, end_date,
+                              offset, by_month=by_month)
+
+    response = fetch(0)
+    result.extend(extracted_pageviews(response))
+    # Stopping before row_count (rather than at it) is correct because the
+    # first row is considered row 0 according to
+    # https://developers.google.com/analytics/devguides/reporting/data/v1/rest/v1beta/properties/runReport#body.request_body.FIELDS.offset
+    # So e.g. if there are five rows, they will be rows 0,1,2,3,4, and if
+    # offset is >=5 then there will be no more rows to fetch. (I also
+    # empirically checked that this is the actual behavior of the API.)
+    offsets = range(LIMIT, response.row_count, LIMIT)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # executor.map yields the responses in order of offset
+        for response in executor.map(fetch, offsets):
+            result.extend(extracted_pageviews(response))
     return result
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+            description="Print the CSV of Google Analytics pageviews for the "
+                        "pages of the Timelines Wiki.")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write timings and counters for the run to FILE "
+                             "as JSON")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help="number of report pages to fetch at the same "
+                             "time (default: %(default)s)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep monthly pageviews in cache.db and only "
+                             "fetch the months that are missing")
+    parser.add_argument("--per-page-ranges", action="store_true",
+                        help="count each page's views over its own date range "
+                             "(from proc.pageviews_date_range) instead of over "
+                             "the whole past year")
+    parser.add_argument("--contractwork-sql", metavar="FILE",
+                        help="with --per-page-ranges, read the creation months "
+                             "of pages from the contractwork tasks SQL dump "
+                             "FILE instead of the MySQL database")
+    args = parser.parse_args()
+    proc.CONTRACTWORK_SQL = args.contractwork_sql
+    try:
+        main(per_page_ranges=args.per_page_ranges,
+             concurrency=args.concurrency, incremental=args.incremental)
+    finally:
+        if args.profile:
+            instrument.write_report(args.profile)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+A history of the table: the rows of each run, kept in an sqlite database
+(history.db) so that trends can be looked up without fetching anything
+again.
+
+Each page gets an id in the pages table, and each run adds one row per page
+to snapshots, keyed by (page id, run date). Recording a run again on the
+same date replaces that date's rows. Only the values that change from run to
+run are kept (the contributor lists can be worked out from the payments in
+contractwork).
+
+Usage:
+
+    ./history.py record [--date YYYY-MM-DD] [CSV]
+    ./history.py trend PAGENAME
+    ./history.py growth [--start DATE] [--end DATE] [-n N]
+    ./history.py movers [--field FIELD] [--start DATE] [--end DATE] [-n N]
+"""
+
+import argparse
+import datetime
+import json
+import sqlite3
+import sys
+
+HISTORY_FILE = "history.db"
+
+SCHEMA = """
+create table if not exists pages (
+        id integer primary key,
+        pagename text unique not null
+);
+
+create table if not exists snapshots (
+        page_id integer not null references pages (id),
+        -- YYYY-MM-DD
+        run_date text not null,
+        topic text,
+        last_modified_month text,
+        -- null if the page has no full timeline table
+        number_of_rows integer,
+        payment real,
+        monthly_pageviews integer,
+        monthly_wikipedia_pageviews integer,
+        primary key (page_id, run_date)
+) without rowid;
+
+-- For comparing every page between two runs (growth and movers); looking up
+-- one page's history uses the primary key
+create index if not exists snapshots_run_date on snapshots (run_date, page_id);
+"""
+
+# The fields of snapshots that can be compared between runs
+NUMERIC_FIELDS = ["number_of_rows", "payment", "monthly_pageviews",
+                  "monthly_wikipedia_pageviews"]
+
+
+def connect(path=HISTORY_FILE):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record(conn, rows, run_date):
+    """Save rows (as returned by print_table.load_rows) as the snapshot for
+    run_date (a YYYY-MM-DD string), replacing any saved for that date."""
+    rows = list(rows)
+    with conn:
+        conn.executemany("insert or ignore into pages (pagename) values (?)",
+                         [(row["pagename"],) for row in rows])
+        conn.executemany("""
+                insert into snapshots
+                    (page_id, run_date, topic, last_modified_month,
+                     number_of_rows, payment, monthly_pageviews,
+                     monthly_wikipedia_pageviews)
+                select id, ?, ?, ?, ?, ?, ?, ? from pages where pagename = ?
+                on conflict (page_id, run_date) do update set
+                    topic = excluded.topic,
+                    last_modified_month = excluded.last_modified_month,
+                    number_of_rows = excluded.number_of_rows,
+                    payment = excluded.payment,
+                    monthly_pageviews = excluded.monthly_pageviews,
+                    monthly_wikipedia_pageviews =
+                        excluded.monthly_wikipedia_pageviews""",
+                [(run_date, row["topic"], row["last_modified_month"],
+                  row["number_of_rows"], row["payment"],
+                  row["monthly_pageviews"], row["monthly_wikipedia_pageviews"],
+                  row["pagename"])
+                 for row in rows])
+        # A page missing from this run (deleted or renamed) shouldn't keep a
+        # snapshot from an earlier recording of the same date
+        conn.execute("""
+                delete from snapshots where run_date = ? and page_id not in
+                    (select id from pages where pagename in
+                        (select value from json_each(?)))""",
+                (run_date, json.dumps([row["pagename"] for row in rows])))
+
+
+def run_dates(conn):
+    """Return the dates of the recorded runs, oldest first."""
+    return [run_date for (run_date,) in conn.execute(
+            "select distinct run_date from snapshots order by run_date")]
+
+
+def trend(conn, pagename):
+    """Return a list of (run_date, number_of_rows, monthly_pageviews,
+    monthly_wikipedia_pageviews) for pagename, oldest first."""
+    return conn.execute("""
+            select run_date, number_of_rows, monthly_pageviews,
+                   monthly_wikipedia_pageviews
+            from snapshots join pages on pages.id = snapshots.page_id
+            where pagename = ?
+            order by run_date""", (pagename,)).fetchall()
+
+
+def _run_range(conn, start, end):
+    # By default, compare the first and last runs
+    dates = run_dates(conn)
+    if not dates:
+        return (None, None)
+    return (start or dates[0], end or dates[-1])
+
+
+def changes(conn, field, start=None, end=None, n=10):
+    """
+    Return the n pages whose field changed the most (in absolute terms)
+    between the runs on start and end (by default the first and last runs)
+    as a list of (pagename, value at start, value at end, change). Pages that
+    weren't in both runs are left out.
+    """
+    if field not in NUMERIC_FIELDS:
+        raise ValueError("can't compare %r between runs" % field)
+    start, end = _run_range(conn, start, end)
+    return conn.execute("""
+            select pagename, a.{0}, b.{0}, b.{0} - a.{0} as change
+            from snapshots a
+            join snapshots b on b.page_id = a.page_id and b.run_date = ?
+            join pages on pages.id = a.page_id
+            where a.run_date = ? and change is not null
+            order by abs(change) desc, pagename
+            limit ?""".format(field), (end, start, n)).fetchall()
+
+
+def growth(conn, start=None, end=None, n=10):
+    """Return the n pages whose number of rows grew the most between the
+    runs on start and end, like changes does. Pages without a full timeline
+    table count as having no rows."""
+    start, end = _run_range(conn, start, end)
+    return conn.execute("""
+            select pagename, ifnull(a.number_of_rows, 0),
+                   ifnull(b.number_of_rows, 0),
+                   ifnull(b.number_of_rows, 0) - ifnull(a.number_of_rows, 0)
+                       as change
+            from snapshots a
+            join snapshots b on b.page_id = a.page_id and b.run_date = ?
+            join pages on pages.id = a.page_id
+            where a.run_date = ?
+            order by change desc, pagename
+            limit ?""", (end, start, n)).fetchall()
+
+
+def print_rows(header, rows):
+    print("\t".join(header))
+    for row in rows:
+        print("\t".join("" if x is None else str(x) for x in row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Keep and query a history of the table data.")
+    parser.add_argument("--db", default=HISTORY_FILE,
+                        help="the history database (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser(
+            "record", help="save the rows of a run")
+    record_parser.add_argument("csv", nargs="?",
+                               default="front_page_table_data.csv",
+                               help="the CSV written by proc.py "
+                                    "(default: %(default)s)")
+    record_parser.add_argument("--date", default=datetime.date.today().isoformat(),
+                               help="the date of the run (default: today)")
+
+    trend_parser = subparsers.add_parser(
+            "trend", help="show the rows and pageviews of a page in each run")
+    trend_parser.add_argument("pagename")
+
+    for name, help_text in [("growth", "show the pages whose number of rows "
+                                       "grew the most between two runs"),
+                            ("movers", "show the pages whose numbers changed "
+                                       "the most between two runs")]:
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument("--start", help="the earlier run (default: "
+                                               "the first one)")
+        subparser.add_argument("--end", help="the later run (default: the "
+                                             "last one)")
+        subparser.add_argument("-n", type=int, default=10,
+                               help="number of pages to show "
+                                    "(default: %(default)s)")
+        if name == "movers":
+            subparser.add_argument("--field", choices=NUMERIC_FIELDS,
+                                   default="monthly_pageviews",
+                                   help="what to compare "
+                                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    if args.command == "record":
+        import print_table
+
+        record(conn, print_table.load_rows(args.csv), args.date)
+    elif args.command == "trend":
+        rows = trend(conn, args.pagename)
+        if not rows:
+            print("No history for %s" % args.pagename, file=sys.stderr)
+            sys.exit(1)
+        print_rows(["run_date", "number_of_rows", "monthly_pageviews",
+                    "monthly_wikipedia_pageviews"], rows)
+    elif args.command == "growth":
+        print_rows(["pagename", "start", "end", "change"],
+                   growth(conn, args.start, args.end, args.n))
+    else:
+        print_rows(["pagename", "start", "end", "change"],
+                   changes(conn, args.field, args.start, args.end, args.n))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Timing and counters for the stages of a run (discovery, row counting,
+Wikipedia pageviews, rendering, and so on), written out at the end as a JSON
+report so that slow pages and regressions between monthly runs are easy to
+spot.
+
+Code runs inside a stage with
+
+    with instrument.stage("row_counting", pagename):
+        ...
+
+which adds the time taken to the stage's total and, when a page is given,
+to the stage's list of slowest pages. Anything that happens inside (in the
+same thread) can bump the stage's counters with instrument.count; net.get
+counts requests, bytes (as transferred, so compressed if the response was)
+and retries this way. Counters used so far: requests, bytes, retries,
+cache_hits, cache_misses and checkpoint_hits.
+"""
+
+import contextlib
+import datetime
+import json
+import sys
+import threading
+import time
+
+# How many of the slowest pages to keep for each stage
+SLOWEST_N = 10
+
+_lock = threading.Lock()
+_local = threading.local()
+_stages = {}
+_started = datetime.datetime.now()
+_started_clock = time.perf_counter()
+
+
+def current_stage():
+    return getattr(_local, "stage", None)
+
+
+def _stage_stats(name):
+    # Callers hold _lock
+    if name not in _stages:
+        _stages[name] = {"seconds": 0.0, "calls": 0, "counters": {},
+                         "slowest": []}
+    return _stages[name]
+
+
+@contextlib.contextmanager
+def stage(name, page=None):
+    """Time the code in the with block as part of stage name (and as work on
+    page, if given)."""
+    previous = current_stage()
+    _local.stage = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _local.stage = previous
+        with _lock:
+            stats = _stage_stats(name)
+            stats["seconds"] += elapsed
+            stats["calls"] += 1
+            if page is not None:
+                slowest = stats["slowest"]
+                slowest.append((elapsed, page))
+                slowest.sort(reverse=True)
+                del slowest[SLOWEST_N:]
+
+
+def count(counter, n=1, stage=None):
+    """Add n to counter in stage (by default the stage we are currently in,
+    or "other" if we aren't in one)."""
+    name = stage or current_stage() or "other"
+    with _lock:
+        counters = _stage_stats(name)["counters"]
+        counters[counter] = counters.get(counter, 0) + n
+
+
+def report():
+    """Return everything recorded so far as a dict that can be dumped as
+    JSON."""
+    with _lock:
+        stages = {name: {"seconds": round(stats["seconds"], 3),
+                         "calls": stats["calls"],
+                         **stats["counters"],
+                         "slowest": [{"page": page,
+                                      "seconds": round(seconds, 3)}
+                                     for seconds, page in stats["slowest"]]}
+                  for name, stats in _stages.items()}
+    return {"script": sys.argv[0],
+            "started": _started.isoformat(timespec="seconds"),
+            "wall_seconds": round(time.perf_counter() - _started_clock, 3),
+            "stages": stages}
+
+
+def write_report(path):
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""
+The HTTP client shared by the scripts in this repository.
+
+Requests to each host go through one pooled requests.Session (so connections
+are kept alive and reused, and responses are gzip-compressed), always have a
+timeout, are paced by a per-host token bucket and a cap on the number of
+simultaneous requests, and are retried with jittered exponential backoff when
+the connection fails or the server says it is overloaded.
+"""
+
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import cassette
+import instrument
+
+# Seconds to wait for a connection, and then for the server to send data
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# A request is tried at most 1 + MAX_RETRIES times. Before retry number n
+# (counting from 0) we wait around BACKOFF_BASE * 2**n seconds, or as long as
+# the server asks us to in its Retry-After header.
+MAX_RETRIES = 4
+BACKOFF_BASE = 2
+BACKOFF_MAX = 120
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Maximum number of simultaneous requests to each host. The timelines wiki
+# runs on a small server, so we go easy on it; Wikimedia can take more, but
+# asks API clients to keep the number of concurrent requests modest.
+HOST_CONCURRENCY = {
+        "timelines.issarice.com": 4,
+        "wikimedia.org": 8,
+        }
+DEFAULT_CONCURRENCY = 4
+
+# Sustained requests per second and burst size for each host
+HOST_RATES = {
+        "timelines.issarice.com": (5, 5),
+        "wikimedia.org": (50, 50),
+        }
+DEFAULT_RATE = (5, 5)
+
+
+class TokenBucket:
+    """Allow on average rate calls per second to take, with bursts of up to
+    burst calls."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait until a call is allowed."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now even if it isn't there yet (the count goes
+            # negative), so that callers waiting at the same time queue up
+            # behind each other instead of all waking at once
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_lock = threading.Lock()
+_sessions = {}
+_semaphores = {}
+_buckets = {}
+
+
+def set_host_concurrency(host, limit):
+    """Allow at most limit simultaneous requests to host."""
+    with _lock:
+        HOST_CONCURRENCY[host] = limit
+        _semaphores.pop(host, None)
+        _sessions.pop(host, None)
+
+
+def set_host_rate(host, rate, burst=None):
+    """Allow on average rate requests per second to host."""
+    with _lock:
+        HOST_RATES[host] = (rate, burst if burst is not None else max(1, rate))
+        _buckets.pop(host, None)
+
+
+def _host_state(host):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _lock:
+        if host not in _sessions:
+            limit = HOST_CONCURRENCY.get(host, DEFAULT_CONCURRENCY)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limit)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+            _semaphores[host] = threading.BoundedSemaphore(limit)
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(*HOST_RATES.get(host, DEFAULT_RATE))
+        return (_sessions[host], _semaphores[host], _buckets[host])
+
+
+def retry_after(response):
+    """Return the number of seconds the server asked us to wait in the
+    Retry-After header of response, or None if it didn't say."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    import email.utils
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, when.timestamp() - time.time())
+
+
+def backoff(attempt):
+    """Seconds to wait before retry number attempt: exponential, with the
+    second half of the interval randomized so that threads that failed
+    together don't all retry together."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def transferred_bytes(response):
+    """The number of bytes of response's body that came over the network,
+    which for a gzip-compressed response is less than len(response.content)."""
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit():
+        return int(length)
+    # Without a Content-Length (a chunked response), ask the underlying
+    # urllib3 response how much it read, before decompressing
+    try:
+        return response.raw.tell()
+    except (AttributeError, OSError):
+        return len(response.content)
+
+
+def get(url, **kwargs):
+    """
+    Like requests.get, but with the pooling, timeouts, rate limiting and
+    retries described at the top of this module. The response of the final
+    try is returned even if it has an error status; if the final try can't
+    connect, the exception is raised.
+
+    When a cassette is being replayed, the recorded response is returned
+    without making any request; when one is being recorded, the response is
+    added to it.
+    """
+    if cassette.replaying():
+        return cassette.replay_response(url, kwargs.get("params"))
+    import requests
+
+    host = urllib.parse.urlparse(url).hostname
+    session, semaphore, bucket = _host_state(host)
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    attempt = 0
+    while True:
+        bucket.take()
+        try:
+            with semaphore:
+                instrument.count("requests")
+                response = session.get(url, **kwargs)
+            instrument.count("bytes", transferred_bytes(response))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = backoff(attempt)
+            logging.info("Request to %s failed (%s); retrying in %.1f seconds",
+                         host, e, delay)
+        else:
+            if response.status_code not in RETRY_STATUSES or \
+                    attempt >= MAX_RETRIES:
+                if cassette.recording():
+                    cassette.record_response(url, kwargs.get("params"),
+                                             response)
+                return response
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff(attempt)
+            delay = min(delay, BACKOFF_MAX)
+            logging.info("Request to %s got status %s; retrying in %.1f seconds",
+                         host, response.status_code, delay)
+        instrument.count("retries")
+        time.sleep(delay)
+        attempt += 1
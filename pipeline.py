@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""
+Build table.mediawiki by running each step of the monthly update as a
+separate stage, in parallel where the steps don't depend on each other:
+
+    ga ----------.              .--> render
+    contractwork -+--> proc ---+
+    crawl -------'              '--> history
+
+ga fetches the Google Analytics pageviews (ga.csv), contractwork aggregates
+the contractwork tasks dump into the cache, crawl finds the timelines on the
+wiki and counts their rows (crawl.json), proc puts everything together into
+front_page_table_data.csv, render prints table.mediawiki and history saves
+the rows in history.db.
+
+Before running a stage, a hash is computed of its command, the files it
+reads (including the outputs of the stages it comes after, and every module
+of this repository that its scripts import) and, for stages
+whose result depends on the date, the current month or day. A stage whose
+hash is the same as when it last succeeded, and whose outputs are still
+there, is skipped. The hashes are kept in STATE_FILE. crawl always runs,
+since its input is the wiki itself.
+"""
+
+import argparse
+import ast
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import contractwork
+
+STATE_FILE = ".pipeline-state.json"
+
+
+def stages(tasks_sql, proc_flags=()):
+    """
+    Return the stages as a dict mapping each stage's name to a dict with
+
+        command  the command to run
+        stdout   the file to save the command's standard output to, if any
+        outputs  the files the stage makes
+        inputs   the files the stage reads (the modules that the Python
+                 files among them import are added by stage_inputs)
+        after    the stages that have to finish first
+        period   "month" or "day" if the result of the stage depends on
+                 the date, or "always" if the stage is never skipped
+    """
+    proc_flags = list(proc_flags)
+    return {
+        "ga": {"command": ["./ga4_pageviews_fetch.py"],
+               "stdout": "ga.csv",
+               "outputs": ["ga.csv"],
+               "inputs": ["ga4_pageviews_fetch.py"],
+               "after": [],
+               "period": "month"},
+        "contractwork": {"command": ["./contractwork.py", tasks_sql],
+                         "outputs": [],
+                         "inputs": ["contractwork.py", tasks_sql],
+                         "after": [],
+                         "period": None},
+        "crawl": {"command": ["./proc.py", "--incremental", "--crawl-only",
+                              "--output", "crawl.json"] + proc_flags,
+                  "outputs": ["crawl.json"],
+                  "inputs": [],
+                  "after": [],
+                  "period": "always"},
+        "proc": {"command": ["./proc.py", "--revisions", "crawl.json",
+                             "--contractwork-sql", tasks_sql,
+                             "--output", "front_page_table_data.csv"]
+                            + proc_flags,
+                 "outputs": ["front_page_table_data.csv"],
+                 "inputs": ["proc.py", "ga.csv", "crawl.json", tasks_sql],
+                 "after": ["ga", "contractwork", "crawl"],
+                 "period": "month"},
+        "render": {"command": ["./print_table.py"],
+                   "stdout": "table.mediawiki",
+                   "outputs": ["table.mediawiki"],
+                   "inputs": ["print_table.py", "schema.sql",
+                              "front_page_table_data.csv"],
+                   "after": ["proc"],
+                   # The table says the date it was made
+                   "period": "day"},
+        "history": {"command": ["./history.py", "record",
+                                "front_page_table_data.csv"],
+                    "outputs": ["history.db"],
+                    "inputs": ["history.py", "front_page_table_data.csv"],
+                    "after": ["proc"],
+                    "period": "month"},
+    }
+
+
+def local_imports(path):
+    """Return the names of the modules of this repository that the Python
+    file path imports, anywhere in the file (proc, for one, imports some
+    modules inside the functions that need them)."""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and \
+                not node.level:
+            names.add(node.module.split(".")[0])
+    directory = os.path.dirname(path)
+    return {name for name in names
+            if os.path.exists(os.path.join(directory, name + ".py"))}
+
+
+def stage_inputs(stage):
+    """Return the inputs of stage together with every module of this
+    repository that the Python files among them import, directly or through
+    other modules, so that editing e.g. util.py makes proc and render run
+    again."""
+    inputs = list(stage["inputs"])
+    seen = set(inputs)
+    queue = [path for path in inputs if path.endswith(".py")]
+    while queue:
+        path = queue.pop()
+        if not os.path.exists(path):
+            continue
+        for name in sorted(local_imports(path)):
+            module = os.path.join(os.path.dirname(path), name + ".py")
+            if module not in seen:
+                seen.add(module)
+                inputs.append(module)
+                queue.append(module)
+    return inputs
+
+
+def stage_hash(stage):
+    """Hash everything that decides what stage makes, as described at the
+    top of this module."""
+    h = hashlib.sha256()
+    h.update(json.dumps(stage["command"]).encode("utf-8"))
+    for path in stage_inputs(stage):
+        h.update(path.encode("utf-8"))
+        if os.path.exists(path):
+            h.update(contractwork.file_checksum(path).encode("ascii"))
+        else:
+            h.update(b"missing")
+    today = datetime.date.today()
+    if stage["period"] == "month":
+        h.update(today.strftime("%Y%m").encode("ascii"))
+    elif stage["period"] == "day":
+        h.update(today.isoformat().encode("ascii"))
+    return h.hexdigest()
+
+
+def load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state):
+    temporary = STATE_FILE + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(temporary, STATE_FILE)
+
+
+def run_stage(name, stage):
+    """Run the command of stage, saving its standard output if it has a
+    stdout file, and return the number of seconds it took. Raises
+    subprocess.CalledProcessError if it fails."""
+    logging.info("Starting %s: %s", name, " ".join(stage["command"]))
+    start = time.perf_counter()
+    if stage.get("stdout"):
+        temporary = stage["stdout"] + ".tmp"
+        with open(temporary, "w") as f:
+            subprocess.run(stage["command"], stdout=f, check=True)
+        os.replace(temporary, stage["stdout"])
+    else:
+        subprocess.run(stage["command"], check=True)
+    return time.perf_counter() - start
+
+
+def run(all_stages, force=()):
+    """
+    Run the stages in all_stages (as returned by stages) in dependency order,
+    each as soon as the stages it comes after have finished, skipping the
+    ones that are up to date unless they are in force. Returns True if every
+    stage succeeded or was skipped.
+    """
+    state = load_state()
+    done = set()
+    failed = set()
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(all_stages)) as executor:
+        while True:
+            # Start every stage that is ready. Skipping a stage (or failing one
+            # that can't run) can make others ready, so go round until
+            # nothing changes.
+            changed = True
+            while changed:
+                changed = False
+                for name, stage in all_stages.items():
+                    if name in done or name in failed or \
+                            name in (n for n, _ in running.values()):
+                        continue
+                    if any(before in failed for before in stage["after"]):
+                        logging.error("Not running %s, as a stage it needs "
+                                      "failed", name)
+                        failed.add(name)
+                        changed = True
+                        continue
+                    if not all(before in done for before in stage["after"]):
+                        continue
+                    # Inputs are only hashed once the stages before have made
+                    # them
+                    key = stage_hash(stage)
+                    if name not in force and stage["period"] != "always" and \
+                            state.get(name) == key and \
+                            all(os.path.exists(path)
+                                for path in stage["outputs"]):
+                        logging.info("Skipping %s, which is up to date", name)
+                        done.add(name)
+                        changed = True
+                        continue
+                    running[executor.submit(run_stage, name, stage)] = \
+                            (name, key)
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name, key = running.pop(future)
+                try:
+                    seconds = future.result()
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logging.error("Stage %s failed: %s", name, e)
+                    state.pop(name, None)
+                    failed.add(name)
+                else:
+                    logging.info("Finished %s in %.1f seconds", name, seconds)
+                    state[name] = key
+                    done.add(name)
+                save_state(state)
+    return not failed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(
+            description="Run the stages that make table.mediawiki, skipping "
+                        "the ones whose inputs haven't changed.")
+    parser.add_argument("--contractwork-sql", metavar="FILE", required=True,
+                        help="the tasks SQL dump of the contractwork "
+                             "repository")
+    parser.add_argument("--proc-flag", action="append", default=[],
+                        metavar="FLAG", dest="proc_flags",
+                        help="pass FLAG on to proc.py (written like "
+                             "--proc-flag=--workers=8); may be given more "
+                             "than once")
+    parser.add_argument("--force", action="append", default=[],
+                        metavar="STAGE",
+                        help="run STAGE even if it is up to date; may be "
+                             "given more than once")
+    args = parser.parse_args()
+    all_stages = stages(args.contractwork_sql, args.proc_flags)
+    for name in args.force:
+        if name not in all_stages:
+            parser.error("no stage named %r" % name)
+    if not run(all_stages, force=set(args.force)):
+        sys.exit(1)
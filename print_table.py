@@ -1,87 +1,197 @@
 #!/usr/bin/env python3
 
+import argparse
 import csv
 import sqlite3
+import sys
 import urllib.parse
 import dateutil.parser
 import datetime
 
+import columnar
+import instrument
 import util
 
-def print_table(reader):
-
-    print("<!-- ")
-    print("Script last ran on:", datetime.date.today().strftime("%Y-%m-%d"))
-    print("WARNING:")
-    print("Do not manually edit this table. This table is produced using\n"
-          "an automated script. The script does not check for manual changes\n"
-          "to the table, so any changes you make will be overwritten the next\n"
-          "time the script runs. The script automatically finds all pages on\n"
-          "the wiki containing \"timeline of\" in the title so any timeline you write will\n"
-          "automatically be included in the table the next time the script\n"
-          "runs. For more information, see the script repository at\n"
-          "https://github.com/riceissa/timelines-wiki-main-page-table")
-    print('-->{| class="sortable wikitable"')
-    print("|-")
-    print("! Timeline subject")
-    print("! Focus area")
-    print("! Creation month")
-    print("! Last modification month")
-    print('! data-sort-type="number" | Number of rows')
-    print('! data-sort-type="number" | Total payment')
-    print('! data-sort-type="number" | Monthly pageviews')
-    print('! data-sort-type="number" | Monthly pageviews on Wikipedia')
-    print('! data-sort-type="text" | Principal contributors')
-
-    for row in reader:
-        number_of_rows = int(row['number_of_rows']) if row['number_of_rows'] else 0
-        if number_of_rows > 10 or float(row['payment']) > 0:
-            print("|-")
-            print("| [[" + row['pagename'] + "|" + util.page_display_name(row['pagename'])
-                  + "]]")
-            print("| " + row['topic'] if row['topic'] else "|")
+def load_rows(path):
+    """Read the CSV written by proc.py at path, with the numeric fields
+    converted (see typed_row)."""
+    with open(path, newline='') as csvfile:
+        return [typed_row(row) for row in csv.DictReader(csvfile)]
+
+
+def typed_row(row):
+    """Convert the numeric fields of a row of the CSV written by proc.py from
+    strings. The number of rows is None when it is blank (meaning the page
+    has no full timeline)."""
+    row = dict(row)
+    row['number_of_rows'] = int(row['number_of_rows']) if row['number_of_rows'] else None
+    row['payment'] = float(row['payment'])
+    row['monthly_pageviews'] = int(row['monthly_pageviews'])
+    row['monthly_wikipedia_pageviews'] = int(row['monthly_wikipedia_pageviews'])
+    return row
+
+
+def print_table(rows, out=sys.stdout):
+    """Print the main table for rows (as returned by load_rows). The lines
+    are put together in memory and written to out at once."""
+    lines = []
+    line = lines.append
+
+    line("<!-- ")
+    line("Script last ran on: " + datetime.date.today().strftime("%Y-%m-%d"))
+    line("WARNING:")
+    line("Do not manually edit this table. This table is produced using\n"
+         "an automated script. The script does not check for manual changes\n"
+         "to the table, so any changes you make will be overwritten the next\n"
+         "time the script runs. The script automatically finds all pages on\n"
+         "the wiki containing \"timeline of\" in the title so any timeline you write will\n"
+         "automatically be included in the table the next time the script\n"
+         "runs. For more information, see the script repository at\n"
+         "https://github.com/riceissa/timelines-wiki-main-page-table")
+    line('-->{| class="sortable wikitable"')
+    line("|-")
+    line("! Timeline subject")
+    line("! Focus area")
+    line("! Creation month")
+    line("! Last modification month")
+    line('! data-sort-type="number" | Number of rows')
+    line('! data-sort-type="number" | Total payment')
+    line('! data-sort-type="number" | Monthly pageviews')
+    line('! data-sort-type="number" | Monthly pageviews on Wikipedia')
+    line('! data-sort-type="text" | Principal contributors')
+
+    for row in rows:
+        number_of_rows = row['number_of_rows'] or 0
+        payment = row['payment']
+        if number_of_rows > 10 or payment > 0:
+            pagename = row['pagename']
+            line("|-")
+            line("| [[" + pagename + "|" + util.page_display_name(pagename) + "]]")
+            line("| " + row['topic'] if row['topic'] else "|")
             if not row['creation_month']:
-                print("| Not yet complete")
+                line("| Not yet complete")
             else:
-                print("| {{dts|" + row['creation_month'] + "}}")
-            print("| {{dts|" + row['last_modified_month'] + "}}")
-            print('| style="text-align:right;" | ' + str(number_of_rows))
-            if float(row['payment']) > 0:
-                print('| style="text-align:right;" | [{} {:.2f}]'.format(
+                line("| {{dts|" + row['creation_month'] + "}}")
+            line("| {{dts|" + row['last_modified_month'] + "}}")
+            line('| style="text-align:right;" | ' + str(number_of_rows))
+            if payment > 0:
+                line('| style="text-align:right;" | [{} {:.2f}]'.format(
                     "https://contractwork.vipulnaik.com/tasks.php?receptacle={}&matching=exact" \
-                            .format(urllib.parse.quote_plus(row['pagename'])),
-                    float(row['payment'])
+                            .format(urllib.parse.quote_plus(pagename)),
+                    payment
                 ))
             else:
-                print('| style="text-align:right;" | 0.00')
-            if int(row['monthly_pageviews']) > 0:
-                print('| style="text-align:right;" | ' + row['monthly_pageviews'])
+                line('| style="text-align:right;" | 0.00')
+            if row['monthly_pageviews'] > 0:
+                line('| style="text-align:right;" | ' + str(row['monthly_pageviews']))
             else:
-                print('| Not yet complete')
-            if int(row['monthly_wikipedia_pageviews']) > 0:
-                print('| style="text-align:right;" | [{} {}]'.format(
+                line('| Not yet complete')
+            if row['monthly_wikipedia_pageviews'] > 0:
+                line('| style="text-align:right;" | [{} {}]'.format(
                     "https://wikipediaviews.org/displayviewsformultiplemonths.php?page={}&allmonths=allmonths&language=en&drilldown=human" \
-                            .format(urllib.parse.quote_plus(row['pagename'])),
+                            .format(urllib.parse.quote_plus(pagename)),
                     row['monthly_wikipedia_pageviews']
                     ))
             else:
-                print('| Not on Wikipedia')
-            try:
-                print('| ' + row['principal_contributors_by_amount_html'])
-            except KeyError:
-                print('|')
-    print("|}")
+                line('| Not on Wikipedia')
+            if row.get('principal_contributors_by_amount_html') is None:
+                line('|')
+            else:
+                line('| ' + row['principal_contributors_by_amount_html'])
+    line("|}")
+    out.write("\n".join(lines) + "\n")
 
 
-def print_summary_tables(reader):
+# The summary tables, in the order they are printed. Each one groups the
+# timelines by a key computed from the row, and is given as (heading, key
+# function, function to format a key for printing, sort key for the groups or
+# None to sort them by key). To add a summary table, add an entry here.
+SUMMARY_TABLES = [
+    ("Principal contributors",
+     lambda row: row['principal_contributors_alphabetical'], str, None),
+    ("Topic", lambda row: row['topic'], str, None),
+    ("Exists on Wikipedia?",
+     lambda row: 'yes' if row['monthly_wikipedia_pageviews'] > 0 else 'no',
+     str, None),
+    ("Creation month", lambda row: row['creation_month'],
+     lambda month: '{{dts|' + month + '}}', lambda month: month_order(month)),
+    ("Last modification month", lambda row: row['last_modified_month'],
+     lambda month: '{{dts|' + month + '}}', lambda month: month_order(month)),
+    # Like substr(creation_month, -4) in SQL
+    ("Creation year", lambda row: row['creation_month'][-4:], str, None),
+    ("Last modification year", lambda row: row['last_modified_month'][-4:],
+     str, None),
+]
+
+
+def summarize(rows, summary_tables=SUMMARY_TABLES):
+    """
+    Go through rows (as returned by load_rows) once and compute the groups of
+    every summary table.
+    Returns a list with, for each table in summary_tables, a dict mapping each
+    key to a list [number of timelines, total monthly pageviews, total
+    monthly pageviews on Wikipedia, total number of rows].
+    """
+    key_functions = [key for _, key, _, _ in summary_tables]
+    groups = [{} for _ in summary_tables]
+    for row in rows:
+        views = row['monthly_pageviews']
+        wp_views = row['monthly_wikipedia_pageviews']
+        number_of_rows = row['number_of_rows'] or 0
+        for key, table_groups in zip(key_functions, groups):
+            totals = table_groups.setdefault(key(row), [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += views
+            totals[2] += wp_views
+            totals[3] += number_of_rows
+    return groups
+
+
+def print_summary_tables(rows, out=sys.stdout):
+    """Print the summary tables, computed in memory in one pass over rows (as
+    returned by load_rows). This prints the same thing as
+    print_summary_tables_sqlite."""
+    lines = []
+    line = lines.append
+    for (heading, _, format_key, sort_key), table_groups in \
+            zip(SUMMARY_TABLES, summarize(rows)):
+        line('{| class="sortable wikitable"')
+        line("|-")
+        line('! ' + heading)
+        line('! data-sort-type="number" | Number of timelines')
+        line('! data-sort-type="number" | Total monthly pageviews')
+        line('! data-sort-type="number" | Total monthly pageviews on Wikipedia')
+        line('! data-sort-type="number" | Total number of rows')
+        # Sort by key first, which is the order sqlite's group by gives
+        keys = sorted(table_groups)
+        if sort_key:
+            keys.sort(key=sort_key)
+        for key in keys:
+            num_timelines, sum_views, sum_wp_views, sum_row_num = table_groups[key]
+            line("|-")
+            line('| ' + format_key(key))
+            line('| style="text-align:right;" | {:,}'.format(num_timelines))
+            line('| style="text-align:right;" | {:,}'.format(sum_views))
+            line('| style="text-align:right;" | {:,}'.format(sum_wp_views))
+            line('| style="text-align:right;" | {:,}'.format(sum_row_num))
+        line("|}")
+    out.write("\n".join(lines) + "\n")
+
+
+def print_summary_tables_sqlite(typed_rows):
+    """Print the summary tables by loading the rows (as returned by
+    load_rows) into timelines.db and grouping them with SQL queries."""
     conn = sqlite3.connect('timelines.db')
     cursor = conn.cursor()
     with open('schema.sql', 'r') as f:
         cursor.executescript(f.read())
 
     rows = []
-    for row in reader:
-        rows.append(tuple(row[field] for field in util.fieldnames))
+    for row in typed_rows:
+        # A blank number of rows has to stay blank rather than become null,
+        # so that sums over only blanks come out as 0
+        rows.append(tuple('' if row[field] is None else row[field]
+                          for field in util.fieldnames))
     cursor.executemany("insert into t (" + ", ".join(util.fieldnames) + ") values (" + ",".join(["?"] * len(util.fieldnames)) + ");", rows)
 
 
@@ -310,13 +420,35 @@ def month_order(month_string):
 
 
 if __name__ == "__main__":
-    with open('front_page_table_data.csv', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        print_table(reader)
-
-    # The main table can just use the CSV as given, but for the summary tables,
-    # we want to import into sqlite so we can group things. So re-read the CSV
-    # to import into a temporary database.
-    with open('front_page_table_data.csv', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        print_summary_tables(reader)
+    parser = argparse.ArgumentParser(
+            description="Print the Timelines Wiki main page table as wikitext.")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write timings for the run to FILE as JSON")
+    parser.add_argument("--columnar", metavar="FILE",
+                        help="read the table data from FILE, written by "
+                             "`proc.py --columnar`, instead of "
+                             "front_page_table_data.csv")
+    parser.add_argument("--sqlite-summary", action="store_true",
+                        help="compute the summary tables with sqlite (in "
+                             "timelines.db) rather than in memory")
+    args = parser.parse_args()
+
+    # Read the CSV once; both the main table and the summary tables are
+    # printed from the same rows
+    if args.columnar:
+        rows = columnar.read_rows(args.columnar)
+    else:
+        rows = load_rows('front_page_table_data.csv')
+    with instrument.stage("rendering"):
+        print_table(rows)
+
+    with instrument.stage("summary_tables"):
+        if args.sqlite_summary:
+            # This prints with print(), which also goes to sys.stdout, so the
+            # output stays in order
+            print_summary_tables_sqlite(rows)
+        else:
+            print_summary_tables(rows)
+
+    if args.profile:
+        instrument.write_report(args.profile)
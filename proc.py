@@ -1,34 +1,101 @@
 #!/usr/bin/env python3
 
-from bs4 import BeautifulSoup
+# Importing this module should stay cheap and free of side effects, so that
+# other scripts can use functions like pageviews_date_range and
+# dictionary_ordering. So heavy libraries (requests, dateutil,
+# mysql.connector) are imported where they are used, and data sources (the
+# contractwork database, ga.csv, EMAIL.txt) are only read the first time they
+# are needed. `make check-import` checks the import time.
+
+import argparse
 import json
-import requests
 import sys
 import csv
 import datetime
-import dateutil.parser
+import functools
 import logging
-import urllib
-import mysql.connector
+import os
+import threading
+import urllib.parse
 import time
-from pathlib import Path
-
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import cassette
+import columnar
+import contractwork
+import instrument
+import net
+import table_scanner
 import util
-
-logging.basicConfig(level=logging.INFO)
+import wp_dumps
 
 TW_COOKIES = {'humancheck': 'is_human'}
 
+# Number of pages whose data is fetched at the same time in write_csv. How
+# many requests actually go to each host at once is limited separately, by
+# net.HOST_CONCURRENCY.
+MAX_WORKERS = 16
+
+# Ask the wiki to refuse our queries while its database is lagged by more than
+# this many seconds (see https://www.mediawiki.org/wiki/Manual:Maxlag_parameter),
+# and give up after being refused this many times in a row.
+MAXLAG = 5
+MAXLAG_RETRIES = 10
+
+# MediaWiki forgets recent changes after 90 days by default ($wgRCMaxAge), so
+# a manifest older than this can't be brought up to date from them, and all
+# pages are listed again instead. Changes are looked for from RC_OVERLAP
+# before the manifest's time, in case our clock and the wiki's disagree.
+RC_MAX_AGE = datetime.timedelta(days=90)
+RC_OVERLAP = datetime.timedelta(hours=1)
+
+# The format of timestamps in the MediaWiki API
+MW_TIMESTAMP = "%Y-%m-%dT%H:%M:%SZ"
+
+# Path to the tasks SQL dump of the contractwork repository. If set, payments
+# are read from it instead of from the contractwork MySQL database.
+CONTRACTWORK_SQL = None
+
+# If True, Google Analytics pageviews are worked out from the monthly
+# pageviews that `ga4_pageviews_fetch.py --incremental` keeps in the cache,
+# instead of from ga.csv
+GA_MONTHLY_STORE = False
+
+
+_provider_lock = threading.RLock()
+
+
+def memoized(f):
+    """Decorator for functions without arguments that load some data: f is
+    only called the first time the data is needed (even if several threads
+    ask at once), and its result is kept for later calls."""
+    result = []
+
+    @functools.wraps(f)
+    def wrapper():
+        if not result:
+            with _provider_lock:
+                if not result:
+                    result.append(f())
+        return result[0]
+    return wrapper
+
+
+@memoized
+def contact_email():
+    """The email address to put in the User-Agent of requests to the
+    Wikimedia API, from the first line of EMAIL.txt."""
+    try:
+        with open("EMAIL.txt", "r") as f:
+            return next(f).strip()
+    except FileNotFoundError:
+        print("Please create a file called EMAIL.txt containing your email on the first line.\n"
+              "This is for querying the WikiMedia pageviews API. See\n"
+              "https://meta.wikimedia.org/wiki/User-Agent_policy for more\n"
+              "information about this requirement.")
+        sys.exit()
 
-try:
-    with open("EMAIL.txt", "r") as f:
-        EMAIL = next(f).strip()
-except FileNotFoundError:
-    print("Please create a file called EMAIL.txt containing your email on the first line.\n"
-          "This is for querying the WikiMedia pageviews API. See\n"
-          "https://meta.wikimedia.org/wiki/User-Agent_policy for more\n"
-          "information about this requirement.")
-    sys.exit()
 
 # By checking the contractwork database, we can tell most of the time whether a
 # timeline is complete or not by looking at the total payment (if it's zero,
@@ -36,7 +103,7 @@ except FileNotFoundError:
 # are "non-paid", meaning someone made it outside of contract work and it won't
 # ever receive payment. Since the contractwork database doesn't track these
 # timelines, we have to list them out here.
-ARTICLES = {
+NON_PAID_ARTICLES = {
         "Timeline of Bay Area Rapid Transit":
             {"topic": "Transportation", "creation_month": "May 2017"},
         "Timeline of Carl Shulman publications":
@@ -86,35 +153,56 @@ ARTICLES = {
         }
 
 
-if Path("/etc/fedora-release").exists():
-    cnx = mysql.connector.connect(user='issa', database='contractwork',
-                                  unix_socket='/var/lib/mysql/mysql.sock')
-else:
-    cnx = mysql.connector.connect(user='issa', database='contractwork')
-cursor = cnx.cursor()
-cursor.execute("""select task_receptacle,sum(payment),min(topic),min(completion_date)
-               from tasks group by task_receptacle""")
+@memoized
+def contractwork_data():
+    """
+    Return a pair (articles, principal_contributors). articles maps each
+    timeline in NON_PAID_ARTICLES or the contractwork database to its topic,
+    creation month and (for paid timelines) total payment;
+    principal_contributors maps each paid timeline to a list of (worker,
+    amount paid) pairs.
+
+    The data comes from the contractwork MySQL database, or if
+    CONTRACTWORK_SQL is set, straight from that tasks SQL dump.
+    """
+    if CONTRACTWORK_SQL:
+        with instrument.stage("contractwork_sql"):
+            receptacle_rows, worker_rows = \
+                    contractwork.tasks_sql_aggregates(CONTRACTWORK_SQL)
+    else:
+        with instrument.stage("mysql"):
+            receptacle_rows, worker_rows = contractwork.mysql_aggregates()
+
+    articles = dict(NON_PAID_ARTICLES)
+    articles.update({x[0]: {"payment": x[1], "topic": x[2],
+                            "creation_month": x[3].strftime("%B %Y")}
+                     for x in receptacle_rows})
+
+    principal_contributors = {}
+    for task_receptacle, worker, total_payment in worker_rows:
+        if task_receptacle not in principal_contributors:
+            principal_contributors[task_receptacle] = []
+        principal_contributors[task_receptacle].append((worker, total_payment))
+    return (articles, principal_contributors)
+
 
-ARTICLES.update({x[0]: {"payment": x[1], "topic": x[2],
-                        "creation_month": x[3].strftime("%B %Y")}
-                 for x in cursor.fetchall()})
+def articles():
+    return contractwork_data()[0]
 
-PRINCIPAL_CONTRIBUTORS = {}
-cursor.execute("""select task_receptacle, worker, sum(payment) from tasks
-                  group by task_receptacle, worker""")
-for task_receptacle, worker, total_payment in cursor.fetchall():
-    if task_receptacle not in PRINCIPAL_CONTRIBUTORS:
-        PRINCIPAL_CONTRIBUTORS[task_receptacle] = []
-    PRINCIPAL_CONTRIBUTORS[task_receptacle].append((worker, total_payment))
 
-cursor.close()
-cnx.close()
+def principal_contributors():
+    return contractwork_data()[1]
 
-GA_PAGEVIEWS = {}
-with open("ga.csv", newline='') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        GA_PAGEVIEWS[row['page_path']] = row['pageviews']
+
+@memoized
+def ga_pageviews_index():
+    """Map each page path in ga.csv to its pageviews (as a string)."""
+    result = {}
+    with open("ga.csv", newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            result[row['page_path']] = row['pageviews']
+    return result
 
 
 def ga_pageviews(pagename):
@@ -125,7 +213,12 @@ def ga_pageviews(pagename):
     if not start_date or not end_date:
         return 0
     path = "/wiki/" + pagename.replace(" ", "_")
-    return int(GA_PAGEVIEWS.get(path, 0)) / (end_date - start_date).days * 30
+    if GA_MONTHLY_STORE:
+        monthly_views = cache.get_ga_monthly_pageviews(path)
+        views = sum(monthly_views.get(month, 0)
+                    for month in months_in_range(start_date, end_date))
+        return views / (end_date - start_date).days * 30
+    return int(ga_pageviews_index().get(path, 0)) / (end_date - start_date).days * 30
 
 
 def dictionary_ordering(x):
@@ -135,12 +228,12 @@ def dictionary_ordering(x):
 
 
 def payment(pagename):
-    return round(ARTICLES.get(pagename, {"payment": 0.0}).get("payment", 0.0), 2)
+    return round(articles().get(pagename, {"payment": 0.0}).get("payment", 0.0), 2)
 
 
 def topic(pagename):
-    if pagename in ARTICLES:
-        return ARTICLES[pagename]["topic"]
+    if pagename in articles():
+        return articles()[pagename]["topic"]
     return ""
 
 
@@ -159,30 +252,57 @@ def creation_month(pagename):
     if pagename in overrides:
         return overrides[pagename]
 
-    if pagename in ARTICLES:
-        return ARTICLES[pagename]["creation_month"]
+    if pagename in articles():
+        return articles()[pagename]["creation_month"]
     return ""
 
 
 # Modified from https://www.mediawiki.org/wiki/API:Query#Continuing_queries
-def query(request, sleep=1):
+def query(request):
+    """
+    Run the API query request, following continuations, and yield the
+    "query" part of each result.
+
+    We don't wait between continuations unless the wiki tells us it is busy
+    (a maxlag or ratelimited error), in which case we wait as long as it asks
+    (or twice as long as last time), and then wait less after each result
+    that goes through. The request rate is also capped by net.get.
+    """
     request['action'] = 'query'
     request['format'] = 'json'
+    request.setdefault('maxlag', MAXLAG)
     lastContinue = {'continue': ''}
     iteration = 0
+    delay = 0
+    refusals = 0
     while True:
         # Clone original request
         req = request.copy()
         # Modify it with the values returned in the 'continue' section of the
         # last result.
         req.update(lastContinue)
+        if delay:
+            time.sleep(delay)
         # Call API
-        r = requests.get("https://timelines.issarice.com/api.php",
-                         params=req, cookies=TW_COOKIES)
+        r = net.get("https://timelines.issarice.com/api.php",
+                    params=req, cookies=TW_COOKIES)
         result = r.json()
-        logging.info("QUERY: ON ITERATION %s, SLEEPING FOR %s", iteration, sleep)
-        time.sleep(sleep)
+        logging.info("QUERY: ON ITERATION %s, WAITED %.2f SECONDS", iteration,
+                     delay)
         iteration += 1
+        if result.get('error', {}).get('code') in ('maxlag', 'ratelimited'):
+            refusals += 1
+            instrument.count("retries")
+            if refusals > MAXLAG_RETRIES:
+                raise ValueError(r.url, result['error'])
+            delay = min(max(net.retry_after(r) or 0, delay * 2, 1),
+                        net.BACKOFF_MAX)
+            logging.info("QUERY: wiki is busy (%s); retrying in %s seconds",
+                         result['error'].get('info'), delay)
+            # Retry the same continuation
+            continue
+        refusals = 0
+        delay = delay / 2 if delay >= 0.25 else 0
         if 'error' in result:
             raise ValueError(r.url, result['error'])
         if 'warnings' in result:
@@ -194,16 +314,133 @@ def query(request, sleep=1):
         lastContinue = result['continue']
 
 
-def pagename_generator():
+def page_revisions():
+    """
+    Return a dict mapping the title of each timeline on the wiki to a dict
+    with the revid and timestamp of its latest revision.
+
+    This walks the wiki's list of (non-redirect) pages, asking for the latest
+    revision of each page in the same requests (as many pages per request as
+    the wiki allows), so that we don't need to call last_modified_month (one
+    request per page) afterwards.
+    """
+    payload = {
+            "generator": "allpages",
+            "gapfilterredir": "nonredirects",
+            "gaplimit": "max",
+            "prop": "revisions|info",
+            "rvprop": "ids|timestamp",
+            }
+    pages = {}
+    for result in query(payload):
+        for page in result.get("pages", {}).values():
+            _add_revision(pages, page)
+    return pages
+
+
+def _add_revision(pages, page):
+    # Add page, from the "pages" part of a query result, to pages if it is a
+    # timeline. When a batch of revisions doesn't fit in one response, the
+    # same page can show up again in a later continuation, sometimes without
+    # its revisions, so merge what we find rather than overwriting it.
+    title = page["title"]
+    if "timeline of " not in title.lower():
+        return
+    revision = pages.setdefault(title, {"revid": page.get("lastrevid"),
+                                        "timestamp": None})
+    if page.get("revisions"):
+        revision["revid"] = page["revisions"][0]["revid"]
+        revision["timestamp"] = page["revisions"][0]["timestamp"]
+
+
+def changed_titles(since):
+    """
+    Return the set of titles of the articles that have been created, edited,
+    deleted or restored since the MediaWiki timestamp since, including both
+    the old and the new title of pages that have been moved.
+    """
+    titles = set()
+    payload = {
+            "list": "recentchanges",
+            "rcstart": since,
+            "rcdir": "newer",
+            "rcnamespace": 0,
+            "rctype": "edit|new",
+            "rcprop": "title",
+            "rclimit": "max",
+            }
+    for result in query(payload):
+        for change in result.get("recentchanges", []):
+            titles.add(change["title"])
+    # Log entries are filed under the namespace of the page they were logged
+    # for, which for a move is the old title, so a page drafted in User: or
+    # Draft: and moved into the main namespace would be missed by
+    # rcnamespace=0. Fetch the log entries from every namespace instead and
+    # keep those that touch the main namespace.
     payload = {
-            "list": "allpages",
-            "apfilterredir": "nonredirects",
-            "aplimit": 50,
+            "list": "recentchanges",
+            "rcstart": since,
+            "rcdir": "newer",
+            "rctype": "log",
+            "rcprop": "title|loginfo",
+            "rclimit": "max",
             }
     for result in query(payload):
-        for page in result["allpages"]:
-            if "timeline of " in page["title"].lower():
-                yield page["title"]
+        for change in result.get("recentchanges", []):
+            if change.get("ns") == 0:
+                titles.add(change["title"])
+            params = change.get("logparams", {})
+            if params.get("target_title") and params.get("target_ns") == 0:
+                titles.add(params["target_title"])
+    return titles
+
+
+def title_revisions(titles):
+    """Return a dict like the one page_revisions returns, for those of titles
+    that are timelines and that exist (and aren't redirects)."""
+    titles = sorted(titles)
+    pages = {}
+    # The API takes at most 50 titles at a time
+    for i in range(0, len(titles), 50):
+        payload = {
+                "titles": "|".join(titles[i:i + 50]),
+                "prop": "revisions|info",
+                "rvprop": "ids|timestamp",
+                }
+        for result in query(payload):
+            for page in result.get("pages", {}).values():
+                if "missing" in page or "invalid" in page or \
+                        "redirect" in page:
+                    continue
+                _add_revision(pages, page)
+    return pages
+
+
+def incremental_page_revisions():
+    """
+    Return the same as page_revisions, but by updating the manifest saved in
+    the cache by the last run with the pages that have changed since (see
+    changed_titles) rather than by listing every page on the wiki. Pages that
+    haven't changed keep their revision, so their rows can be computed from
+    the cache. If there is no manifest, or it is older than RC_MAX_AGE, every
+    page is listed with page_revisions.
+    """
+    started = datetime.datetime.now(datetime.timezone.utc)
+    updated, pages = cache.get_manifest()
+    if updated is not None:
+        updated = datetime.datetime.strptime(updated, MW_TIMESTAMP) \
+                .replace(tzinfo=datetime.timezone.utc)
+    if updated is None or started - updated > RC_MAX_AGE:
+        logging.info("No recent manifest of pages; listing all pages")
+        pages = page_revisions()
+    else:
+        titles = changed_titles((updated - RC_OVERLAP).strftime(MW_TIMESTAMP))
+        logging.info("%s pages changed since %s", len(titles), updated)
+        for title in titles:
+            pages.pop(title, None)
+        pages.update(title_revisions(titles))
+    cache.set_manifest(started.strftime(MW_TIMESTAMP), pages)
+    return pages
 
 
 def pageviews_date_range(pagename, destination=None):
@@ -220,7 +457,7 @@ def pageviews_date_range(pagename, destination=None):
     # pageviews
     if not cm:
         return (None, None)
-    today = datetime.date.today()
+    today = cassette.today()
 
     # Start getting pageviews data from the month following the creation of the
     # page or 12 months ago, whichever comes later. We want to average over at
@@ -244,16 +481,52 @@ def pageviews_date_range(pagename, destination=None):
     return (start_date, end_date)
 
 
+def months_in_range(start_date, end_date):
+    """List the months from start_date to end_date (inclusive) as YYYYMM
+    strings."""
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append("%04d%02d" % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
 def wp_pageviews(pagename):
     """
     Get monthly Wikipedia pageviews data for pagename.
+
+    Monthly totals are kept in the cache, so only the months we haven't seen
+    before (normally just the last one) are downloaded.
     """
     start_date, end_date = pageviews_date_range(pagename)
     if not start_date or not end_date:
         return 0
-    # m = str(start_date.month) if start_date.month >= 10 else "0" + \
-    #         str(start_date.month)
-    # start = str(start_date.year) + m + "01"
+    months = months_in_range(start_date, end_date)
+    monthly_views = cache.get_wp_monthly_pageviews(pagename)
+    missing = [month for month in months if month not in monthly_views]
+    instrument.count("cache_misses" if missing else "cache_hits")
+    if missing:
+        first_missing = datetime.datetime.strptime(missing[0], "%Y%m").date()
+        fetched = fetch_wp_monthly_pageviews(pagename, first_missing, end_date)
+        # A month that the API leaves out had no pageviews (or the page didn't
+        # exist on Wikipedia yet), except that the latest month may just not
+        # have been published yet, so don't remember that one as zero.
+        new_views = {month: fetched.get(month, 0) for month in missing
+                     if month in fetched or month != months[-1]}
+        cache.set_wp_monthly_pageviews(pagename, new_views)
+        monthly_views.update(fetched)
+    views = sum(monthly_views.get(month, 0) for month in months)
+    return views / (end_date - start_date).days * 30
+
+
+def fetch_wp_monthly_pageviews(pagename, start_date, end_date):
+    """
+    Download the monthly Wikipedia pageviews of pagename between start_date
+    and end_date from the Wikimedia API, as a dict mapping YYYYMM strings to
+    pageviews. Months without any pageviews are left out. Raises
+    requests.HTTPError if the API returns an error other than 404.
+    """
     start = datetime.datetime.strftime(start_date, "%Y%m%d")
     end = datetime.datetime.strftime(end_date, "%Y%m%d")
 
@@ -262,34 +535,27 @@ def wp_pageviews(pagename):
           urllib.parse.quote(pagename, safe="") + \
           "/monthly/" + start + "/" + end
 
-    logging.info("Querying Wikipedia pageviews for %s", pagename)
-    headers = {
-        "User-Agent": "TimelinesWikiMainPageTableUpdateScript/1.0 (https://github.com/riceissa/timelines-wiki-main-page-table/; {}) python-requests/{} bot".format(EMAIL, requests.__version__),
-    }
-    try:
-        r = requests.get(url, headers=headers)
-    except:
-        time.sleep(2)
-        logging.info("Query for Wikipedia pageviews failed; sleeping for 2 seconds and then retrying")
-        try:
-            r = requests.get(url, headers=headers)
-        except:
-            time.sleep(4)
-            logging.info("Query for Wikipedia pageviews failed; sleeping for 4 seconds and then retrying")
-            try:
-                r = requests.get(url, headers=headers)
-            except:
-                time.sleep(8)
-                logging.info("Query for Wikipedia pageviews failed; sleeping for 8 seconds and then retrying (this will be the final try)")
-                r = requests.get(url, headers=headers)
+    import requests
 
+    logging.info("Querying Wikipedia pageviews for %s", pagename)
+    headers = {}
+    # Nothing is sent when replaying a cassette, so EMAIL.txt isn't needed
+    if not cassette.replaying():
+        headers["User-Agent"] = "TimelinesWikiMainPageTableUpdateScript/1.0 (https://github.com/riceissa/timelines-wiki-main-page-table/; {}) python-requests/{} bot".format(contact_email(), requests.__version__)
+    # net.get retries failed connections and overloaded responses itself
+    r = net.get(url, headers=headers)
+    # A 404 means the page isn't on Wikipedia (or has no pageviews in the
+    # range); any other error must not be taken for months without pageviews,
+    # as those would be cached as zeros
+    if r.status_code == 404:
+        return {}
+    r.raise_for_status()
     result = r.json()
-    views = 0
-    if 'items' not in result:
-        return 0
-    for month in result['items']:
-        views += int(month['views'])
-    return views / (end_date - start_date).days * 30
+    monthly_views = {}
+    # Timestamps look like 2023050100
+    for month in result.get('items', []):
+        monthly_views[month['timestamp'][:6]] = int(month['views'])
+    return monthly_views
 
 
 def full_timeline_heading(soup):
@@ -330,65 +596,326 @@ def last_modified_month(pagename):
             "format": "json",
             }
     logging.info("Querying last modified month for %s", pagename)
-    r = requests.get("https://timelines.issarice.com/api.php",
-                     params=payload, cookies=TW_COOKIES)
+    r = net.get("https://timelines.issarice.com/api.php",
+                params=payload, cookies=TW_COOKIES)
     result = r.json()
-    return dateutil.parser.parse(list(result['query']['pages'].values())[0]['revisions'][0]['timestamp']).strftime("%B %Y")
+    return timestamp_month(list(result['query']['pages'].values())[0]['revisions'][0]['timestamp'])
+
+
+def timestamp_month(timestamp):
+    """Convert a MediaWiki timestamp like 2023-05-17T04:12:55Z into a month
+    like "May 2023"."""
+    import dateutil.parser
 
+    return dateutil.parser.parse(timestamp).strftime("%B %Y")
 
-def number_of_rows(pagename):
+
+def number_of_rows(pagename, revid=None):
+    """
+    Count the rows in the full timeline table of pagename. If revid (the
+    latest revision of the page) is given, the count is looked up in and saved
+    to the cache, so pages that haven't changed since the last run don't get
+    parsed again.
+    """
+    if revid is not None:
+        found, rows = cache.get_number_of_rows(pagename, revid)
+        if found:
+            instrument.count("cache_hits")
+            return rows
+    instrument.count("cache_misses")
+    rows = parse_number_of_rows(pagename, revid)
+    if revid is not None:
+        cache.set_number_of_rows(pagename, revid, rows)
+    return rows
+
+
+def parse_number_of_rows(pagename, revid=None):
     payload = {
         "action": "parse",
-        "page": pagename,
         "format": "json",
     }
+    # Parse exactly the revision we are caching under, in case the page was
+    # edited since we looked up its latest revision
+    if revid is not None:
+        payload["oldid"] = revid
+    else:
+        payload["page"] = pagename
 
     logging.info("Querying number of rows for %s", pagename)
-    r = requests.get("https://timelines.issarice.com/api.php",
-                     params=payload, cookies=TW_COOKIES)
+    r = net.get("https://timelines.issarice.com/api.php",
+                params=payload, cookies=TW_COOKIES)
     result = r.json()
     text = result["parse"]["text"]["*"]
-    soup = BeautifulSoup(text, "lxml")
+    # This finds the same table as full_timeline_heading and
+    # full_timeline_table, but without parsing the whole page into a tree.
+    # Returns "" if it could not find the full timeline.
+    return table_scanner.count_rows(text)
 
-    h2 = full_timeline_heading(soup)
-    full_timeline = full_timeline_table(soup, h2)
-    if full_timeline:
-        return len(full_timeline.find_all("tr")) - 1
+def table_row(pagename, revision=None):
+    """
+    Fetch and compute everything that goes in the row for pagename. If the
+    latest revision of the page is already known (as returned by
+    page_revisions), it can be passed in to save a request.
+    """
+    with instrument.stage("last_modified", pagename):
+        if revision and revision["timestamp"]:
+            modified_month = timestamp_month(revision["timestamp"])
+        else:
+            modified_month = last_modified_month(pagename)
+    with instrument.stage("row_counting", pagename):
+        rows = number_of_rows(pagename,
+                              revision["revid"] if revision else None)
+    with instrument.stage("ga_pageviews", pagename):
+        monthly_pageviews = int(ga_pageviews(pagename))
+    with instrument.stage("wp_pageviews", pagename):
+        monthly_wikipedia_pageviews = int(wp_pageviews(pagename))
+    row_dict = {'pagename': pagename,
+                'topic': topic(pagename),
+                'creation_month': creation_month(pagename),
+                'last_modified_month': modified_month,
+                'number_of_rows': rows,
+                'payment': payment(pagename),
+                'monthly_pageviews': monthly_pageviews,
+                'monthly_wikipedia_pageviews': monthly_wikipedia_pageviews}
+    if pagename in principal_contributors():
+        contributors = list(sorted(principal_contributors()[pagename],
+                                   key=lambda x: x[1],
+                                   reverse=True))
+        row_dict['principal_contributors_by_amount'] = ", ".join(
+                worker for worker, _ in contributors)
+        row_dict['principal_contributors_by_amount_html'] = ", ".join(
+                '<span title="%s">%s</span>' % ("$" + str(payment), worker)
+                for worker, payment in contributors)
+        contributors = list(sorted(principal_contributors()[pagename],
+                                   key=lambda x: x[0]))
+        row_dict['principal_contributors_alphabetical'] = ", ".join(
+                worker for worker, _ in contributors)
     else:
-        # Could not find full timeline
-        return ""
+        row_dict['principal_contributors_by_amount'] = ""
+        row_dict['principal_contributors_alphabetical'] = ""
+        row_dict['principal_contributors_by_amount_html'] = ""
+    return row_dict
+
+
+def checkpoint_run():
+    """The key under which rows are checkpointed: rows computed in the same
+    month (which have the same pageview date ranges) can be reused."""
+    return cassette.today().strftime("%Y%m")
+
+
+def checkpointed_row(pagename, revision=None):
+    """Like table_row, but the row is saved in the cache as soon as it has
+    been computed, and a row saved by an earlier, unfinished run this month
+    for the same revision is returned instead of computing it again."""
+    revid = revision["revid"] if revision else None
+    data = cache.get_checkpoint(checkpoint_run(), pagename, revid)
+    if data is not None:
+        instrument.count("checkpoint_hits")
+        return json.loads(data)
+    row_dict = table_row(pagename, revision)
+    # Payments are Decimals, which are saved as the strings the CSV would
+    # have anyway
+    cache.set_checkpoint(checkpoint_run(), pagename, revid,
+                         json.dumps(row_dict, default=str))
+    return row_dict
+
+
+def crawl(max_workers=MAX_WORKERS, incremental=False):
+    """
+    Do the part of write_csv that only needs the wiki: find the timelines
+    (with page_revisions, or incremental_page_revisions if incremental is
+    True) and count the rows of each, which saves the counts in the cache.
+    Returns the same as page_revisions, which can be passed to write_csv.
+    """
+    with instrument.stage("discovery"):
+        if incremental:
+            revisions = incremental_page_revisions()
+        else:
+            revisions = page_revisions()
+
+    def count_rows(pagename):
+        with instrument.stage("row_counting", pagename):
+            number_of_rows(pagename, revisions[pagename]["revid"])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(count_rows, revisions))
+    return revisions
+
+
+def write_csv(csvfile, max_workers=MAX_WORKERS, wp_dump_dir=None,
+              columnar_path=None, incremental=False, revisions=None):
+    """Write the table data for every timeline to csvfile.
+
+    Each row is checkpointed in the cache as it is computed (see
+    checkpointed_row), and nothing is written until every row is done, so if
+    the run fails partway through, running it again this month only computes
+    the rows that are missing. The checkpoints are removed once everything
+    has been written.
+
+    Pages are fetched concurrently (at most max_workers at a time, subject to
+    the per-host limits in net.HOST_CONCURRENCY), but rows are written in
+    dictionary order as they would be if the pages were fetched one by one.
+
+    If wp_dump_dir is given, Wikipedia pageviews for the months that have a
+    dump in that directory are read from the dumps (see wp_dumps) rather than
+    from the pageviews API.
 
-def write_csv(csvfile):
+    If columnar_path is given, the rows are also written there in the typed
+    columnar format (see columnar), which print_table.py can read instead of
+    the CSV.
+
+    If incremental is True, the list of pages is brought up to date from the
+    wiki's recent changes (see incremental_page_revisions) instead of being
+    fetched in full. If the pages are already known (e.g. from crawl), they
+    can be passed in as revisions instead.
+    """
+    # Rows saved by runs in earlier months are of no more use
+    cache.clear_checkpoints(keep_run=checkpoint_run())
+    if revisions is None:
+        with instrument.stage("discovery"):
+            if incremental:
+                revisions = incremental_page_revisions()
+            else:
+                revisions = page_revisions()
+    pagenames = sorted(revisions, key=dictionary_ordering)
+    if wp_dump_dir:
+        with instrument.stage("wp_dumps"):
+            wp_dumps.ingest(wp_dump_dir, pagenames)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # executor.map yields results in the order of pagenames, regardless of
+        # the order in which they finish
+        rows = list(executor.map(checkpointed_row, pagenames,
+                                 [revisions[p] for p in pagenames]))
     writer = csv.DictWriter(csvfile, fieldnames=util.fieldnames)
     writer.writeheader()
-    for pagename in sorted(pagename_generator(), key=dictionary_ordering):
-        row_dict = {'pagename': pagename,
-                    'topic': topic(pagename),
-                    'creation_month': creation_month(pagename),
-                    'last_modified_month': last_modified_month(pagename),
-                    'number_of_rows': number_of_rows(pagename),
-                    'payment': payment(pagename),
-                    'monthly_pageviews': int(ga_pageviews(pagename)),
-                    'monthly_wikipedia_pageviews': int(wp_pageviews(pagename))}
-        if pagename in PRINCIPAL_CONTRIBUTORS:
-            contributors = list(sorted(PRINCIPAL_CONTRIBUTORS[pagename],
-                                       key=lambda x: x[1],
-                                       reverse=True))
-            row_dict['principal_contributors_by_amount'] = ", ".join(
-                    worker for worker, _ in contributors)
-            row_dict['principal_contributors_by_amount_html'] = ", ".join(
-                    '<span title="%s">%s</span>' % ("$" + str(payment), worker)
-                    for worker, payment in contributors)
-            contributors = list(sorted(PRINCIPAL_CONTRIBUTORS[pagename],
-                                       key=lambda x: x[0]))
-            row_dict['principal_contributors_alphabetical'] = ", ".join(
-                    worker for worker, _ in contributors)
-        else:
-            row_dict['principal_contributors_by_amount'] = ""
-            row_dict['principal_contributors_alphabetical'] = ""
-            row_dict['principal_contributors_by_amount_html'] = ""
-        writer.writerow(row_dict)
+    writer.writerows(rows)
+    if columnar_path:
+        columnar.write(columnar_path, rows)
+    cache.clear_checkpoints()
+
+
+def write_output(path, write):
+    """Call write with a file to write to: path, or standard output if path
+    is None. path is written under a temporary name and renamed once write
+    returns, so that it is never left half-written."""
+    if path is None:
+        write(sys.stdout)
+        return
+    temporary = path + ".tmp"
+    with open(temporary, "w", newline="") as f:
+        write(f)
+    os.replace(temporary, path)
+
+
+def host_limit(arg):
+    """Parse a HOST=N command-line argument."""
+    host, sep, limit = arg.partition("=")
+    if not sep or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError("expected HOST=N, got %r" % arg)
+    return (host, int(limit))
 
 
 if __name__ == "__main__":
-    write_csv(sys.stdout)
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+            description="Print the CSV of data for the Timelines Wiki main page table.")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="number of pages to fetch concurrently "
+                             "(default: %(default)s)")
+    parser.add_argument("--host-concurrency", type=host_limit, action="append",
+                        default=[], metavar="HOST=N",
+                        help="allow at most N simultaneous requests to HOST; "
+                             "may be given more than once")
+    parser.add_argument("--connect-timeout", type=float,
+                        default=net.CONNECT_TIMEOUT,
+                        help="seconds to wait for a connection "
+                             "(default: %(default)s)")
+    parser.add_argument("--read-timeout", type=float, default=net.READ_TIMEOUT,
+                        help="seconds to wait for a server to send data "
+                             "(default: %(default)s)")
+    parser.add_argument("--wp-dump-dir", metavar="DIR",
+                        help="read Wikipedia pageviews from the monthly "
+                             "pageview dumps in DIR where available")
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument("--record", metavar="CASSETTE",
+                                help="save every HTTP response and database "
+                                     "result of this run to CASSETTE")
+    cassette_group.add_argument("--replay", metavar="CASSETTE",
+                                help="use the responses saved in CASSETTE "
+                                     "instead of the network and database")
+    parser.add_argument("--contractwork-sql", metavar="FILE",
+                        help="read payments from the contractwork tasks SQL "
+                             "dump FILE instead of the MySQL database")
+    parser.add_argument("--ga-monthly-store", action="store_true",
+                        help="compute Google Analytics pageviews from the "
+                             "monthly pageviews stored by "
+                             "`ga4_pageviews_fetch.py --incremental` rather "
+                             "than from ga.csv")
+    parser.add_argument("--incremental", action="store_true",
+                        help="find the pages that changed since the last run "
+                             "from the wiki's recent changes instead of "
+                             "listing every page")
+    parser.add_argument("--columnar", metavar="FILE",
+                        help="also write the table data to FILE in the typed "
+                             "columnar format (see columnar.py)")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the CSV to FILE (replacing it only once "
+                             "every row is done) instead of standard output")
+    parser.add_argument("--crawl-only", action="store_true",
+                        help="only find the timelines and count their rows, "
+                             "and write the timelines and their latest "
+                             "revisions as JSON (for --revisions) instead of "
+                             "the CSV")
+    parser.add_argument("--revisions", metavar="FILE",
+                        help="take the timelines and their latest revisions "
+                             "from FILE, written by --crawl-only, instead of "
+                             "finding them on the wiki")
+    parser.add_argument("--fresh", action="store_true",
+                        help="compute every row again, rather than reusing "
+                             "the rows saved by an unfinished earlier run")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write timings and counters for each stage of "
+                             "the run to FILE as JSON")
+    args = parser.parse_args()
+    for host, limit in args.host_concurrency:
+        net.set_host_concurrency(host, limit)
+    net.CONNECT_TIMEOUT = args.connect_timeout
+    net.READ_TIMEOUT = args.read_timeout
+    CONTRACTWORK_SQL = args.contractwork_sql
+    GA_MONTHLY_STORE = args.ga_monthly_store
+    if args.record or args.replay:
+        # Don't let cached data from earlier runs stand in for requests, so
+        # that a cassette has everything a run needs
+        cache.CACHE_FILE = ":memory:"
+        if args.record:
+            cassette.start(args.record, cassette.RECORD)
+        else:
+            cassette.start(args.replay, cassette.REPLAY)
+    if args.fresh:
+        cache.clear_checkpoints()
+    try:
+        if args.crawl_only:
+            revisions = crawl(max_workers=args.workers,
+                              incremental=args.incremental)
+            write_output(args.output,
+                         lambda f: json.dump(revisions, f, indent=1,
+                                             sort_keys=True))
+        else:
+            # Fail right away, rather than partway through, if EMAIL.txt is
+            # missing (a replay makes no requests, so doesn't need it)
+            if not cassette.replaying():
+                contact_email()
+            revisions = None
+            if args.revisions:
+                with open(args.revisions) as f:
+                    revisions = json.load(f)
+            # Load the contractwork data before starting the threads
+            contractwork_data()
+            write_output(args.output, lambda f: write_csv(
+                f, max_workers=args.workers, wp_dump_dir=args.wp_dump_dir,
+                columnar_path=args.columnar, incremental=args.incremental,
+                revisions=revisions))
+    finally:
+        cassette.save()
+        if args.profile:
+            instrument.write_report(args.profile)
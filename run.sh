@@ -4,23 +4,22 @@ set -euxo pipefail
 git remote update -p && git merge --ff-only @{u}
 
 thisdir="$(pwd)"
+contractworkdir=~/projects/vipulnaik/contractwork
 
-make clean
-
-# Re-run google analytics script to get a new `ga.csv`
-make ga.csv
-
-# git pull from Vipul's contract work repo, then re-read the `tasks.sql`
-# file, to get new payments info
-cd ~/projects/vipulnaik/contractwork/
+# git pull from Vipul's contract work repo to get new payments info. proc.py
+# reads the `tasks.sql` dump directly, so there's no need to reload the
+# MySQL database.
+cd "$contractworkdir"
 git remote update -p && git merge --ff-only @{u}
-make reset && make read_public
 
 # Return to the timelines-wiki-main-page-table directory
 cd "$thisdir"
 
-# Re-run `proc.py`. The Wikipedia pageviews fetching is included in this.
-make table.mediawiki
+# Fetch the Google Analytics pageviews, aggregate the payments and crawl the
+# wiki (all at the same time), then run `proc.py` (which fetches the
+# Wikipedia pageviews) and `print_table.py`. Stages whose inputs haven't
+# changed since the last run are skipped; see pipeline.py.
+./pipeline.py --contractwork-sql "$contractworkdir/sql/tasks.sql"
 
 # Normally doing `explorer.exe .` does not require the &, but for some reason
 # within a script, not having the & will just end the script right here.
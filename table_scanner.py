@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+Count the rows of the full timeline table in a rendered timeline page without
+building a tree of the whole page.
+
+This gives the same answers as running proc.full_timeline_heading and
+proc.full_timeline_table on the BeautifulSoup of the page and counting the
+<tr> tags, but does it in one pass over the HTML, keeping only the stack of
+currently open tag names. To check the scanner on the pages in fixtures()
+(against the counts recorded there, and against BeautifulSoup if it is
+installed), and to compare it with BeautifulSoup on some saved pages, run:
+
+    ./table_scanner.py --fixtures page1.html page2.html ...
+"""
+
+import argparse
+from html.parser import HTMLParser
+import sys
+
+HEADINGS = {"Full timeline", "Timeline"}
+
+# Elements that never have an end tag
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "link", "meta", "param", "source", "track", "wbr"}
+
+# Elements whose end tag may be left out; a new start tag of one of these
+# implicitly closes the open one (within the same table or list)
+IMPLIED_END = {"p": {"p"}, "li": {"li"}, "dt": {"dt", "dd"}, "dd": {"dt", "dd"},
+               "tr": {"tr", "td", "th"}, "td": {"td", "th"},
+               "th": {"td", "th"}, "option": {"option"}}
+SCOPE_ELEMENTS = {"table", "ul", "ol", "dl", "select"}
+
+# Scanner states
+SEARCHING, IN_HEADING, AFTER_HEADING, COUNTING, DONE = range(5)
+
+
+class FullTimelineScanner(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.state = SEARCHING
+        self.heading_text = []
+        # Depth of the element whose next siblings we search for the table
+        # (the parent of the heading), and later of the table itself
+        self.level = None
+        self.rows = 0
+        self.result = ""
+
+    def handle_starttag(self, tag, attrs):
+        if self.state == DONE:
+            return
+        self._close_implied(tag)
+        if self.state == SEARCHING and tag == "h2":
+            self.heading_text = []
+            self.state = IN_HEADING
+        elif self.state == AFTER_HEADING and len(self.stack) == self.level:
+            # A following sibling of the heading's parent
+            if tag == "table" and not self._excluded(attrs):
+                self.state = COUNTING
+        elif self.state == COUNTING and tag == "tr":
+            self.rows += 1
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        # e.g. <br/>; treat it like a start tag that is immediately closed
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS and self.stack and self.stack[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.state == DONE or tag not in self.stack:
+            # Stray end tag; ignore it like an HTML parser would
+            return
+        while self.stack:
+            closed = self.stack.pop()
+            self._closed(closed)
+            if closed == tag or self.state == DONE:
+                break
+
+    def handle_data(self, data):
+        if self.state == IN_HEADING:
+            self.heading_text.append(data)
+
+    def close(self):
+        super().close()
+        if self.state == COUNTING:
+            # The page ended inside the table, which a tree builder would
+            # close for us
+            self.result = self.rows - 1
+            self.state = DONE
+
+    def _closed(self, tag):
+        depth = len(self.stack)
+        if self.state == IN_HEADING and tag == "h2":
+            if "".join(self.heading_text).strip() in HEADINGS:
+                # The stack now ends with the heading's parent; its siblings
+                # will be at the parent's depth once it closes
+                self.level = depth - 1
+                self.state = AFTER_HEADING if self.level >= 0 else DONE
+            else:
+                self.state = SEARCHING
+        elif self.state == AFTER_HEADING and depth < self.level:
+            # The heading's grandparent closed, so we stepped right through
+            # the page without finding the table
+            self.state = DONE
+        elif self.state == COUNTING and depth == self.level:
+            self.result = self.rows - 1
+            self.state = DONE
+
+    def _close_implied(self, tag):
+        closes = IMPLIED_END.get(tag)
+        if not closes:
+            return
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i] in SCOPE_ELEMENTS:
+                return
+            if self.stack[i] in closes:
+                self.handle_endtag(self.stack[i])
+                return
+
+    @staticmethod
+    def _excluded(attrs):
+        classes = dict(attrs).get("class")
+        if classes is None:
+            # proc.full_timeline_table does `"not-full-timeline" in
+            # tag.get("class")`, which fails the same way for a table without
+            # a class attribute
+            raise TypeError("argument of type 'NoneType' is not iterable")
+        return "not-full-timeline" in classes.split()
+
+
+def count_rows(html):
+    """
+    Return the number of rows (not counting the header row) in the full
+    timeline table of the rendered page html, or "" if there is no full
+    timeline table.
+    """
+    scanner = FullTimelineScanner()
+    scanner.feed(html)
+    scanner.close()
+    return scanner.result
+
+
+def soup_count_rows(html):
+    """Count rows the way proc.number_of_rows originally did, by building the
+    whole tree with BeautifulSoup."""
+    from bs4 import BeautifulSoup
+    import proc
+
+    soup = BeautifulSoup(html, "lxml")
+    h2 = proc.full_timeline_heading(soup)
+    full_timeline = proc.full_timeline_table(soup, h2)
+    if full_timeline:
+        return len(full_timeline.find_all("tr")) - 1
+    return ""
+
+
+def fixtures():
+    """
+    Return a list of (name, html, expected) triples: pages laid out like the
+    wiki's (see bench.timeline_html) and the cases where the scanner has to
+    follow what a tree builder does, each with the number of rows that
+    soup_count_rows gives for it.
+    """
+    import bench
+
+    page = bench.timeline_html(30)
+    heading = ('<div class="mw-heading mw-heading2"><h2 id="Full_timeline">'
+               'Full timeline</h2></div>')
+    header = '<tr><th>Year</th><th>Details</th></tr>'
+
+    def rows(n):
+        return "".join('<tr><td>%d</td><td>Event %d</td></tr>' % (2000 + i, i)
+                       for i in range(n))
+
+    def wrap(body):
+        return ('<html><body><div class="mw-parser-output">%s</div>'
+                '</body></html>' % body)
+
+    return [
+        ("wiki layout", page, 30),
+        ("not-full-timeline table before the real one",
+         wrap(heading + '<table class="wikitable not-full-timeline">'
+              + header + rows(3) + '</table><table class="wikitable">'
+              + header + rows(5) + '</table>'), 5),
+        ("rows and cells closed by the next tag",
+         wrap(heading + '<table class="wikitable"><tr><th>Year<th>Details'
+              + "".join('<tr><td>%d<td>Event %d' % (2000 + i, i)
+                        for i in range(4))
+              + '</table><p>After the table</p>'), 4),
+        ("nested table",
+         wrap(heading + '<table class="wikitable">' + header
+              + '<tr><td>2000</td><td><table class="inner">' + rows(2)
+              + '</table></td></tr>' + rows(3) + '</table>'), 6),
+        ("table in a wrapper div",
+         wrap(heading + '<div class="wrapper"><table class="wikitable">'
+              + header + rows(3) + '</table></div>'), ""),
+        ("table in a wrapper div, then one that isn't",
+         wrap(heading + '<div class="wrapper"><table class="wikitable">'
+              + header + rows(3) + '</table></div><table class="wikitable">'
+              + header + rows(2) + '</table>'), 2),
+        ("unterminated table",
+         '<html><body><div class="mw-parser-output">' + heading
+         + '<table class="wikitable">' + header + rows(7), 7),
+        # The table is a sibling of the heading, not of its parent, so it
+        # isn't found
+        ("heading directly in the page content",
+         wrap('<h2>Full timeline</h2><table class="wikitable">' + header
+              + rows(3) + '</table>'), ""),
+        ("no full timeline heading",
+         wrap('<div class="mw-heading mw-heading2"><h2>Big picture</h2>'
+              '</div><table class="wikitable">' + header + rows(3)
+              + '</table>'), ""),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Check that the scanner counts the same rows as "
+                        "BeautifulSoup.")
+    parser.add_argument("--fixtures", action="store_true",
+                        help="check the pages in fixtures()")
+    parser.add_argument("paths", nargs="*", metavar="PAGE",
+                        help="a saved rendered page to compare on (needs "
+                             "BeautifulSoup)")
+    args = parser.parse_args()
+    try:
+        import bs4  # noqa: F401
+        have_soup = True
+    except ImportError:
+        have_soup = False
+        if args.paths:
+            parser.error("comparing saved pages needs BeautifulSoup")
+        print("BeautifulSoup isn't installed; only checking against the "
+              "recorded counts", file=sys.stderr)
+
+    cases = []
+    if args.fixtures:
+        cases += [(name, html, expected, True)
+                  for name, html, expected in fixtures()]
+    for path in args.paths:
+        with open(path, encoding="utf-8") as f:
+            cases.append((path, f.read(), None, False))
+
+    mismatches = 0
+    for name, html, expected, recorded in cases:
+        got = count_rows(html)
+        problems = []
+        if recorded and expected != got:
+            problems.append("expected %r" % (expected,))
+        if have_soup:
+            soup = soup_count_rows(html)
+            if soup != got:
+                problems.append("BeautifulSoup gives %r" % (soup,))
+        if problems:
+            mismatches += 1
+            print("MISMATCH %s: scanner gives %r, %s"
+                  % (name, got, ", ".join(problems)))
+        else:
+            print("ok %s: %r" % (name, got))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
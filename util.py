@@ -19,3 +19,12 @@ fieldnames = ['pagename', 'topic', 'creation_month', 'last_modified_month',
               'monthly_wikipedia_pageviews', 'principal_contributors_by_amount',
               'principal_contributors_alphabetical',
               'principal_contributors_by_amount_html']
+
+# The type of each field, used by the columnar format (see columnar.py)
+fieldtypes = {'pagename': 'str', 'topic': 'str', 'creation_month': 'month',
+              'last_modified_month': 'month', 'number_of_rows': 'int',
+              'payment': 'float', 'monthly_pageviews': 'int',
+              'monthly_wikipedia_pageviews': 'int',
+              'principal_contributors_by_amount': 'str',
+              'principal_contributors_alphabetical': 'str',
+              'principal_contributors_by_amount_html': 'str'}
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""
+Read Wikipedia pageviews from the monthly Wikimedia pageview dumps instead of
+asking the pageviews API about one article at a time.
+
+The dumps are the "pageview_complete" monthly files from
+https://dumps.wikimedia.org/other/pageview_complete/monthly/ named like
+pageviews-202305-user.bz2 (only the "user" files are used, to match the
+"user" agent type that proc.wp_pageviews asks the API for). Each line looks
+like
+
+    en.wikipedia Timeline_of_OpenAI 52155 desktop 3321 A101B98C...
+
+that is, the wiki, the title, the page ID, the access method, the total views
+for the month and an encoding of the daily views. There is one line per
+access method, so the lines for an article are added up to get its
+all-access total.
+
+To check the reading of dumps on the small dumps in CHECK_DUMPS, with the
+cache in memory, run:
+
+    ./wp_dumps.py --check
+"""
+
+import bz2
+import gzip
+import logging
+import os
+import re
+
+import cache
+
+DUMP_FILENAME = re.compile(r"^pageviews-(\d{6})-user(?:\.bz2|\.gz)?$")
+
+
+def open_dump(path):
+    """Open a (possibly compressed) dump file for reading as text."""
+    if path.endswith(".bz2"):
+        opener = bz2.open
+    elif path.endswith(".gz"):
+        opener = gzip.open
+    else:
+        opener = open
+    return opener(path, "rt", encoding="utf-8", errors="replace")
+
+
+def dump_files(directory):
+    """Return a list of (month, path) pairs for the dumps in directory, where
+    month is a YYYYMM string."""
+    result = []
+    for filename in sorted(os.listdir(directory)):
+        m = DUMP_FILENAME.match(filename)
+        if m:
+            result.append((m.group(1), os.path.join(directory, filename)))
+    return result
+
+
+def monthly_views(f, pagenames, wiki="en.wikipedia"):
+    """
+    Go through the lines of the dump file f once and return a dict mapping
+    each of pagenames to its total views in the dump. Pages not in the dump
+    get 0. Only the counts for pagenames are kept, so memory use doesn't grow
+    with the size of the dump.
+    """
+    # Titles are written with underscores in the dumps
+    wanted = {pagename.replace(" ", "_"): pagename for pagename in pagenames}
+    views = dict.fromkeys(pagenames, 0)
+    prefix = wiki + " "
+    seen_wiki = False
+    for line in f:
+        if not line.startswith(prefix):
+            if seen_wiki:
+                # The dumps are sorted by wiki, so we are past all of its lines
+                break
+            continue
+        seen_wiki = True
+        parts = line.split(" ")
+        pagename = wanted.get(parts[1])
+        if pagename is not None:
+            views[pagename] += int(parts[-2])
+    return views
+
+
+def ingest(directory, pagenames):
+    """
+    Store the monthly Wikipedia pageviews of pagenames from every dump in
+    directory in the cache, so that proc.wp_pageviews can compute its averages
+    without calling the pageviews API for those months. Dumps whose month is
+    already cached for every page are skipped.
+    """
+    pagenames = list(pagenames)
+    for month, path in dump_files(directory):
+        if cache.has_wp_monthly_pageviews(pagenames, month):
+            continue
+        logging.info("Reading Wikipedia pageviews for %s from %s", month, path)
+        with open_dump(path) as f:
+            views = monthly_views(f, pagenames)
+        for pagename, count in views.items():
+            cache.set_wp_monthly_pageviews(pagename, {month: count})
+
+
+# Small dumps for check(), laid out like the real ones: sorted by wiki, with
+# one line per access method, as (month, compression, lines)
+CHECK_DUMPS = [
+    ("202305", "bz2", [
+        "de.wikipedia Zeitleiste_von_OpenAI 1 desktop 7 A7",
+        "en.wikipedia Timeline_of_AI 10 desktop 40 A40",
+        "en.wikipedia Timeline_of_AI 10 mobile-app 2 B2",
+        "en.wikipedia Timeline_of_AI 10 mobile-web 8 C8",
+        "en.wikipedia Timeline_of_AI_safety 11 desktop 5 A5",
+        "en.wikipedia Timeline_of_OpenAI 12 desktop 300 A300",
+        "en.wikipedia Timeline_of_OpenAI 12 mobile-web 21 C21",
+        "en.wikivoyage Timeline_of_AI 13 desktop 99 A99",
+        "fr.wikipedia Timeline_of_OpenAI 14 desktop 99 A99",
+    ]),
+    ("202306", "gz", [
+        "en.wikibooks Timeline_of_OpenAI 2 desktop 99 A99",
+        "en.wikipedia Timeline_of_OpenAI 12 mobile-web 4 D4",
+        "en.wiktionary Timeline_of_AI 3 desktop 99 A99",
+    ]),
+    ("202307", None, [
+        "en.wikipedia Timeline_of_AI 10 desktop 1 A1",
+        "en.wikipedia Timeline_of_OpenAI 12 desktop 6 A6",
+    ]),
+]
+
+# What ingest should store for the dumps in CHECK_DUMPS
+CHECK_VIEWS = {
+    "Timeline of AI": {"202305": 50, "202306": 0, "202307": 1},
+    "Timeline of OpenAI": {"202305": 321, "202306": 4, "202307": 6},
+    "Timeline of something else": {"202305": 0, "202306": 0, "202307": 0},
+}
+
+
+def check():
+    """Ingest CHECK_DUMPS, written out compressed as they say, with the cache
+    in memory, and return a list of the ways the stored views are wrong."""
+    import tempfile
+
+    cache.CACHE_FILE = ":memory:"
+    openers = {"bz2": bz2.open, "gz": gzip.open, None: open}
+    with tempfile.TemporaryDirectory() as directory:
+        for month, compression, lines in CHECK_DUMPS:
+            filename = "pageviews-%s-user" % month
+            if compression:
+                filename += "." + compression
+            with openers[compression](os.path.join(directory, filename), "wt",
+                                      encoding="utf-8") as f:
+                f.write("".join(line + "\n" for line in lines))
+        ingest(directory, CHECK_VIEWS)
+    problems = []
+    for pagename, expected in CHECK_VIEWS.items():
+        got = cache.get_wp_monthly_pageviews(pagename)
+        if got != expected:
+            problems.append("%s: got %r, expected %r"
+                            % (pagename, got, expected))
+    return problems
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] != ["--check"]:
+        print("Usage: %s --check" % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+    problems = check()
+    for problem in problems:
+        print(problem)
+    print("ok" if not problems else "%d problems" % len(problems))
+    sys.exit(1 if problems else 0)